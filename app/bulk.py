@@ -0,0 +1,249 @@
+"""Offline bulk scoring of JSONL or CSV records.
+
+Reads the input incrementally, dedupes texts by content hash, runs the tasks through the
+packed batch and multi-task paths, and appends one JSON line per input record to the
+output. Progress is checkpointed after every chunk, so rerunning the same command after
+a crash continues where it stopped:
+
+    python -m app.bulk records.jsonl --task classify --output scored.jsonl
+    python -m app.bulk notes.csv --tasks summarize sentiment --text-field note --id-field note_id
+"""
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import os
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import redis.asyncio as redis
+from dotenv import load_dotenv
+
+from .cache import LRUCache, ResultCache, make_cache_key
+from .nlp_tasks import BATCH_CONCURRENCY, CHAT_MODEL, process_multi_task, process_nlp_batch
+
+load_dotenv()
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", 512))
+BULK_CACHE_TTL = int(os.getenv("BULK_CACHE_TTL", 7 * 86400))
+BULK_DEDUPE_SIZE = int(os.getenv("BULK_DEDUPE_SIZE", 200000))
+DEFAULT_CATEGORIES = ["infectious", "chronic", "other"]
+TASKS = ("classify", "extract_entities", "summarize", "sentiment")
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def read_records(path: str) -> Iterator[Tuple[Optional[Dict], Optional[str]]]:
+    """Yield (record, error) per input record without loading the file into memory."""
+    with open(path, encoding="utf-8", newline="") as file:
+        if path.lower().endswith(".csv"):
+            for row in csv.DictReader(file):
+                yield row, None
+            return
+        for line in file:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                yield None, f"Invalid JSON: {e}"
+                continue
+            yield (record, None) if isinstance(record, dict) else (None, "Record is not a JSON object")
+
+def parse_categories(value) -> Optional[List[str]]:
+    """Accept a list of strings or a comma-separated string (e.g. from a CSV column)."""
+    if value is None or value == "" or value == []:
+        return None
+    if isinstance(value, str):
+        value = [part.strip() for part in value.split(",") if part.strip()]
+    if not isinstance(value, list) or not all(isinstance(item, str) and item.strip() for item in value):
+        raise ValueError("'categories' must be a list of strings or a comma-separated string")
+    return value
+
+class BulkScorer:
+    """Score chunks of records, reusing results for repeated texts.
+
+    Results are cached under a ``bulk:`` namespace (they carry no related_docs, so they
+    must not answer API requests): in-process for this run, and in Redis across runs
+    when a client is given.
+    """
+
+    def __init__(self, tasks: List[str], categories: List[str], text_field: str = "text",
+                 id_field: str = "id", concurrency: int = BATCH_CONCURRENCY, redis_client=None):
+        self.tasks = tasks
+        self.categories = categories
+        self.text_field = text_field
+        self.id_field = id_field
+        self.concurrency = concurrency
+        self.cache = ResultCache(redis_client, ttl=BULK_CACHE_TTL,
+                                 local=LRUCache(maxsize=BULK_DEDUPE_SIZE, ttl=BULK_CACHE_TTL), name="bulk")
+        self.stats = {"records": 0, "scored": 0, "reused": 0, "errors": 0}
+
+    def _job(self, record: Dict) -> Tuple[List[str], Optional[List[str]], str]:
+        tasks = record.get("tasks") or ([record["task"]] if record.get("task") else self.tasks)
+        if isinstance(tasks, str):
+            tasks = [tasks]
+        tasks = list(dict.fromkeys(tasks))
+        unknown = [task for task in tasks if task not in TASKS]
+        if unknown:
+            raise ValueError(f"Unknown tasks: {unknown}")
+        text = record.get(self.text_field)
+        if not isinstance(text, str) or not text.strip():
+            raise ValueError(f"Missing '{self.text_field}'")
+        categories = (parse_categories(record.get("categories")) or self.categories) if "classify" in tasks else None
+        return tasks, categories, text
+
+    async def score_chunk(self, chunk: List[Tuple[int, Optional[Dict], Optional[str]]]) -> List[Dict]:
+        outputs: List[Dict] = []
+        keys: Dict[int, str] = {}
+        jobs: Dict[str, Tuple[List[str], Optional[List[str]], str]] = {}
+        for i, (number, record, error) in enumerate(chunk):
+            record_id = record.get(self.id_field, number) if record else number
+            outputs.append({"id": record_id})
+            if error is None:
+                try:
+                    job = self._job(record)
+                except (ValueError, TypeError) as e:
+                    error = str(e)
+            if error is not None:
+                outputs[i]["error"] = error
+                continue
+            tasks, categories, text = job
+            outputs[i]["tasks" if len(tasks) > 1 else "task"] = tasks if len(tasks) > 1 else tasks[0]
+            keys[i] = make_cache_key(f"bulk:{'+'.join(sorted(tasks))}", text, categories, CHAT_MODEL)
+            jobs.setdefault(keys[i], job)
+
+        unique = list(jobs)
+        cached = await asyncio.gather(*(self.cache.get(key) for key in unique))
+        results: Dict[str, object] = {key: value for key, value in zip(unique, cached) if value is not None}
+        todo = [key for key in unique if key not in results]
+        self.stats["reused"] += len(keys) - len(todo)
+
+        # Single-task texts are packed per (task, categories); multi-task texts use one combined call each
+        groups: Dict[Tuple, List[str]] = {}
+        multi = []
+        for key in todo:
+            tasks, categories, _ = jobs[key]
+            if len(tasks) == 1:
+                groups.setdefault((tasks[0], tuple(categories or ())), []).append(key)
+            else:
+                multi.append(key)
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def run_group(task: str, categories: Tuple, group: List[str]):
+            texts = [jobs[key][2] for key in group]
+            batch = await process_nlp_batch(texts, task, list(categories) or None, concurrency=self.concurrency)
+            results.update(zip(group, batch))
+
+        async def run_multi(key: str):
+            tasks, categories, text = jobs[key]
+            async with semaphore:
+                try:
+                    results[key] = await process_multi_task(text, tasks, categories)
+                except Exception as e:
+                    results[key] = e
+
+        await asyncio.gather(
+            *(run_group(task, categories, group) for (task, categories), group in groups.items()),
+            *(run_multi(key) for key in multi)
+        )
+        await asyncio.gather(*(self.cache.set(key, results[key]) for key in todo if not isinstance(results[key], Exception)))
+        self.stats["scored"] += len(todo)
+
+        for i, key in keys.items():
+            result = results[key]
+            if isinstance(result, Exception):
+                outputs[i]["error"] = str(getattr(result, "detail", result))
+            else:
+                outputs[i]["result"] = result
+        self.stats["records"] += len(chunk)
+        self.stats["errors"] += sum(1 for output in outputs if "error" in output)
+        return outputs
+
+def load_checkpoint(path: str, input_path: str) -> Dict:
+    if not os.path.exists(path):
+        return {"input": input_path, "records": 0, "output_bytes": 0}
+    with open(path, encoding="utf-8") as file:
+        checkpoint = json.load(file)
+    if checkpoint.get("input") != os.path.abspath(input_path):
+        raise SystemExit(f"Checkpoint {path} belongs to {checkpoint.get('input')}; pass --restart to start over")
+    return checkpoint
+
+def save_checkpoint(path: str, checkpoint: Dict):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump(checkpoint, file)
+    os.replace(tmp_path, path)
+
+async def run(args):
+    checkpoint_path = args.checkpoint or f"{args.output}.checkpoint.json"
+    if args.restart and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    checkpoint = load_checkpoint(checkpoint_path, args.input)
+    checkpoint["input"] = os.path.abspath(args.input)
+    if checkpoint["records"] and not os.path.exists(args.output):
+        raise SystemExit(f"Checkpoint {checkpoint_path} exists but {args.output} is missing; pass --restart to start over")
+    redis_client = redis.from_url(REDIS_URL)
+    try:
+        await redis_client.ping()
+    except Exception as e:
+        logger.warning(f"Redis unavailable ({e}), results are only reused within this run")
+        await redis_client.aclose()
+        redis_client = None
+    scorer = BulkScorer(args.tasks, args.categories, args.text_field, args.id_field, args.concurrency, redis_client)
+
+    # Drop any lines written after the last checkpoint, then append
+    mode = "r+b" if checkpoint["records"] and os.path.exists(args.output) else "wb"
+    with open(args.output, mode) as output:
+        output.truncate(checkpoint["output_bytes"])
+        output.seek(checkpoint["output_bytes"])
+        if checkpoint["records"]:
+            logger.info(f"Resuming after {checkpoint['records']} records")
+        start, chunk = time.monotonic(), []
+        for number, (record, error) in enumerate(read_records(args.input), start=1):
+            if number <= checkpoint["records"]:
+                continue
+            chunk.append((number, record, error))
+            if len(chunk) < args.chunk_size:
+                continue
+            await write_chunk(scorer, chunk, output, checkpoint, checkpoint_path)
+            chunk = []
+            rate = scorer.stats["records"] / (time.monotonic() - start)
+            logger.info(f"{checkpoint['records']} records done ({rate:.1f}/s) {scorer.stats}")
+        if chunk:
+            await write_chunk(scorer, chunk, output, checkpoint, checkpoint_path)
+    logger.info(f"Finished {checkpoint['records']} records in {time.monotonic() - start:.1f}s: {scorer.stats}")
+    if redis_client is not None:
+        await redis_client.aclose()
+
+async def write_chunk(scorer: BulkScorer, chunk: List, output, checkpoint: Dict, checkpoint_path: str):
+    outputs = await scorer.score_chunk(chunk)
+    output.write("".join(json.dumps(item, ensure_ascii=False) + "\n" for item in outputs).encode("utf-8"))
+    output.flush()
+    os.fsync(output.fileno())
+    checkpoint["records"] = chunk[-1][0]
+    checkpoint["output_bytes"] = output.tell()
+    save_checkpoint(checkpoint_path, checkpoint)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("input", help=".jsonl (one JSON object per line) or .csv with a header row")
+    parser.add_argument("--output", required=True, help="JSONL file with one result line per input record")
+    task_group = parser.add_mutually_exclusive_group(required=True)
+    task_group.add_argument("--task", choices=TASKS, help="task for records that don't name their own")
+    task_group.add_argument("--tasks", nargs="+", choices=TASKS, help="several tasks per record, one combined call each")
+    parser.add_argument("--categories", nargs="+", default=DEFAULT_CATEGORIES)
+    parser.add_argument("--text-field", default="text")
+    parser.add_argument("--id-field", default="id", help="copied to each output line; the record number when missing")
+    parser.add_argument("--chunk-size", type=int, default=BULK_CHUNK_SIZE, help="records per checkpoint")
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY, help="LLM calls in flight per task group")
+    parser.add_argument("--checkpoint", help="defaults to <output>.checkpoint.json")
+    parser.add_argument("--restart", action="store_true", help="ignore an existing checkpoint and overwrite the output")
+    args = parser.parse_args()
+    args.tasks = args.tasks or [args.task]
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
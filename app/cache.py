@@ -0,0 +1,131 @@
+import hashlib
+import json
+import logging
+import os
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from dotenv import load_dotenv
+
+from .metrics import stage_timer, record_cache
+
+load_dotenv()
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", 3600))
+LOCAL_CACHE_SIZE = int(os.getenv("LOCAL_CACHE_SIZE", 1024))
+LOCAL_CACHE_TTL = int(os.getenv("LOCAL_CACHE_TTL", 300))
+CACHE_KEY_PREFIX = "nlp:result:"
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def normalize_text(text: str) -> str:
+    """Collapse whitespace and apply NFC so trivially different inputs share a key."""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+def make_cache_key(task: str, text: str, categories: Optional[List[str]], model: str, batch: Optional[List[str]] = None) -> str:
+    """Content-addressed key over (task, normalized text or batch, categories, model).
+
+    Categories keep their order: it appears in the prompt, and the first one filters retrieval.
+    """
+    material = {
+        "task": task,
+        "text": normalize_text(text),
+        "batch": [normalize_text(item) for item in batch] if batch else None,
+        "categories": list(categories) if categories else None,
+        "model": model,
+    }
+    digest = hashlib.sha256(json.dumps(material, sort_keys=True, separators=(",", ":")).encode("utf-8")).hexdigest()
+    return f"{CACHE_KEY_PREFIX}{digest}"
+
+class LRUCache:
+    """Bounded per-process LRU with a per-entry TTL."""
+
+    def __init__(self, maxsize: int = LOCAL_CACHE_SIZE, ttl: float = LOCAL_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[Dict]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: Dict):
+        if self.maxsize <= 0:
+            return
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+class ResultCache:
+    """Two-tier result cache: in-process LRU in front of Redis, JSON-encoded values.
+
+    With ``redis_client=None`` only the in-process tier is used.
+    """
+
+    def __init__(self, redis_client, ttl: int = RESULT_CACHE_TTL, local: Optional[LRUCache] = None, name: str = "result"):
+        self.redis = redis_client
+        self.name = name
+        self.ttl = ttl
+        self.local = local if local is not None else LRUCache()
+        self.stats = {"local_hits": 0, "redis_hits": 0, "misses": 0, "errors": 0}
+
+    async def get(self, key: str) -> Optional[Dict]:
+        value = self.local.get(key)
+        if value is not None:
+            self.stats["local_hits"] += 1
+            record_cache(self.name, "local_hit")
+            return value
+        if self.redis is None:
+            self.stats["misses"] += 1
+            record_cache(self.name, "miss")
+            return None
+        try:
+            with stage_timer("redis_get"):
+                raw = await self.redis.get(key)
+        except Exception as e:
+            logger.warning(f"Redis cache read failed: {e}")
+            self.stats["errors"] += 1
+            raw = None
+        if raw is None:
+            self.stats["misses"] += 1
+            record_cache(self.name, "miss")
+            return None
+        value = json.loads(raw)
+        self.local.set(key, value)
+        self.stats["redis_hits"] += 1
+        record_cache(self.name, "redis_hit")
+        return value
+
+    async def set(self, key: str, value: Dict):
+        self.local.set(key, value)
+        if self.redis is None:
+            return
+        try:
+            with stage_timer("redis_set"):
+                await self.redis.setex(key, self.ttl, json.dumps(value, separators=(",", ":")))
+        except Exception as e:
+            logger.warning(f"Redis cache write failed: {e}")
+            self.stats["errors"] += 1
+
+    def get_stats(self) -> Dict:
+        hits = self.stats["local_hits"] + self.stats["redis_hits"]
+        lookups = hits + self.stats["misses"]
+        return {
+            **self.stats,
+            "hit_ratio": hits / lookups if lookups else 0.0,
+            "local_size": len(self.local),
+        }
@@ -0,0 +1,63 @@
+import asyncio
+import logging
+import os
+from typing import Dict, Tuple
+
+import httpx
+from dotenv import load_dotenv
+
+load_dotenv()
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", 100))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", 20))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", 30.0))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 5.0))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", 30.0))
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "true").lower() == "true"
+
+# One pooled client per upstream so a slow endpoint cannot starve the others' pools
+UPSTREAMS = ("chat", "embed", "rerank", "webhook")
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+_clients: Dict[str, Tuple[asyncio.AbstractEventLoop, httpx.AsyncClient]] = {}
+
+def _build_client(name: str) -> httpx.AsyncClient:
+    prefix = f"HTTP_{name.upper()}_"
+    limits = httpx.Limits(
+        max_connections=int(os.getenv(f"{prefix}MAX_CONNECTIONS", HTTP_MAX_CONNECTIONS)),
+        max_keepalive_connections=int(os.getenv(f"{prefix}MAX_KEEPALIVE", HTTP_MAX_KEEPALIVE)),
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+    )
+    timeout = httpx.Timeout(float(os.getenv(f"{prefix}TIMEOUT", HTTP_TIMEOUT)), connect=HTTP_CONNECT_TIMEOUT)
+    return httpx.AsyncClient(limits=limits, timeout=timeout, http2=HTTP2_ENABLED)
+
+def get_client(name: str) -> httpx.AsyncClient:
+    """Return the shared client for an upstream, creating it on first use in the running loop.
+
+    Connections are bound to the event loop that opened them, so a client created in
+    another loop (e.g. a previous ``asyncio.run`` in a Celery task) is replaced.
+    """
+    if name not in UPSTREAMS:
+        raise ValueError(f"Unknown upstream: {name}")
+    loop = asyncio.get_running_loop()
+    entry = _clients.get(name)
+    if entry is not None and entry[0] is loop and not entry[1].is_closed:
+        return entry[1]
+    client = _build_client(name)
+    _clients[name] = (loop, client)
+    return client
+
+async def init_http_clients():
+    for name in UPSTREAMS:
+        get_client(name)
+    logger.info(f"HTTP clients initialized for {list(UPSTREAMS)} (http2={HTTP2_ENABLED})")
+
+async def close_http_clients():
+    loop = asyncio.get_running_loop()
+    for name, (client_loop, client) in list(_clients.items()):
+        if client_loop is loop:
+            await client.aclose()
+        _clients.pop(name, None)
+    logger.info("HTTP clients closed")
@@ -0,0 +1,107 @@
+import asyncio
+import fcntl
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+from contextlib import asynccontextmanager
+from typing import Dict, List
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "data/embeddings.sqlite3")
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class EmbeddingStore:
+    """Disk-backed embedding cache keyed by (model, sha256(text)).
+
+    Backed by SQLite in WAL mode so several uvicorn/Celery workers on one host can
+    share it. Vectors are stored as raw float32 bytes.
+    """
+
+    def __init__(self, path: str = EMBEDDING_CACHE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "model TEXT NOT NULL, text_hash TEXT NOT NULL, vector BLOB NOT NULL, "
+                "PRIMARY KEY (model, text_hash))"
+            )
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def get_many(self, texts: List[str], model: str) -> Dict[str, List[float]]:
+        """Return cached vectors for whichever of ``texts`` are present, keyed by text."""
+        hashes = {text_hash(text): text for text in texts}
+        found = {}
+        with self._lock:
+            conn = self._connect()
+            keys = list(hashes)
+            # Stay under SQLite's bound-parameter limit
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                rows = conn.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({','.join('?' * len(chunk))})",
+                    [model, *chunk]
+                ).fetchall()
+                for digest, blob in rows:
+                    found[hashes[digest]] = np.frombuffer(blob, dtype=np.float32).tolist()
+        return found
+
+    def put_many(self, texts: List[str], vectors: List[List[float]], model: str):
+        rows = [
+            (model, text_hash(text), np.asarray(vector, dtype=np.float32).tobytes())
+            for text, vector in zip(texts, vectors)
+        ]
+        with self._lock:
+            conn = self._connect()
+            conn.executemany("INSERT OR REPLACE INTO embeddings (model, text_hash, vector) VALUES (?, ?, ?)", rows)
+            conn.commit()
+
+    async def aget_many(self, texts: List[str], model: str) -> Dict[str, List[float]]:
+        return await asyncio.to_thread(self.get_many, texts, model)
+
+    async def aput_many(self, texts: List[str], vectors: List[List[float]], model: str):
+        await asyncio.to_thread(self.put_many, texts, vectors, model)
+
+@asynccontextmanager
+async def file_lock(name: str, poll: float = 0.2):
+    """Exclusive lock shared by all processes on this host, held on a file next to the store.
+
+    Polls a non-blocking ``flock`` so waiting never ties up a thread and can be cancelled.
+    """
+    directory = os.path.dirname(EMBEDDING_CACHE_PATH)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, f".{name}.lock"), "a") as file:
+        while True:
+            try:
+                fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                await asyncio.sleep(poll)
+        try:
+            yield
+        finally:
+            fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+
+embedding_store = EmbeddingStore()
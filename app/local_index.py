@@ -0,0 +1,122 @@
+import json
+import logging
+import os
+import re
+from collections import deque
+from typing import Dict, FrozenSet, List, Optional, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+LOCAL_INDEX_ENABLED = os.getenv("LOCAL_INDEX_ENABLED", "true").lower() == "true"
+LOCAL_INDEX_DIR = os.getenv("LOCAL_INDEX_DIR", "data/local_index")
+LOCAL_INDEX_DTYPE = os.getenv("LOCAL_INDEX_DTYPE", "float32")
+LOCAL_INDEX_HOT_SIZE = int(os.getenv("LOCAL_INDEX_HOT_SIZE", 1000))
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+def _tokens(text: str) -> FrozenSet[str]:
+    """Lowercased word tokens, like Qdrant's word tokenizer for the `text` full-text index."""
+    return frozenset(re.findall(r"\w+", text.lower()))
+
+def _quantize(vectors: np.ndarray, dtype: str) -> np.ndarray:
+    if dtype == "int8":
+        return np.round(vectors * 127).astype(np.int8)
+    return np.ascontiguousarray(vectors, dtype=np.float32)
+
+class LocalVectorIndex:
+    """In-process cosine index over a task's seed corpus plus a bounded hot set.
+
+    The seed matrix is L2-normalized and stored contiguous (float32, or int8 with
+    scores rescaled by 1/127), and can be memory-mapped from disk so workers on one
+    host share its pages. Category filters match whole words, like Qdrant's full-text
+filter, and use cached boolean masks. Recently learned
+    points from this worker are kept in a small hot set searched alongside it.
+    """
+
+    def __init__(self, texts: List[str], matrix: np.ndarray, hot_size: int = LOCAL_INDEX_HOT_SIZE):
+        self.texts = texts
+        self.matrix = matrix
+        self.scale = 1 / 127 if matrix.dtype == np.int8 else 1.0
+        self._masks: Dict[str, np.ndarray] = {}
+        self._text_tokens: Optional[List[FrozenSet[str]]] = None
+        self._hot: "deque[Tuple[str, np.ndarray, FrozenSet[str]]]" = deque(maxlen=hot_size)
+        self._hot_matrix: Optional[np.ndarray] = None
+
+    @classmethod
+    def build(cls, texts: List[str], vectors: List[List[float]], dtype: str = LOCAL_INDEX_DTYPE) -> "LocalVectorIndex":
+        matrix = _quantize(_normalize(np.asarray(vectors, dtype=np.float32)), dtype)
+        return cls(texts, matrix)
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # Write then rename so concurrent workers never map a partial file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as file:
+            np.save(file, self.matrix)
+        os.replace(tmp_path, path)
+        with open(f"{tmp_path}.json", "w", encoding="utf-8") as file:
+            json.dump(self.texts, file)
+        os.replace(f"{tmp_path}.json", f"{path}.json")
+
+    @classmethod
+    def load(cls, path: str) -> Optional["LocalVectorIndex"]:
+        if not (os.path.exists(path) and os.path.exists(f"{path}.json")):
+            return None
+        with open(f"{path}.json", encoding="utf-8") as file:
+            texts = json.load(file)
+        matrix = np.load(path, mmap_mode="r")
+        if matrix.shape[0] != len(texts):
+            logger.warning(f"Local index {path} is inconsistent, ignoring it")
+            return None
+        return cls(texts, matrix)
+
+    def _mask(self, category: str) -> np.ndarray:
+        mask = self._masks.get(category)
+        if mask is None:
+            if self._text_tokens is None:
+                self._text_tokens = [_tokens(text) for text in self.texts]
+            needle = _tokens(category)
+            mask = np.fromiter((needle <= tokens for tokens in self._text_tokens), dtype=bool, count=len(self.texts))
+            self._masks[category] = mask
+        return mask
+
+    def add_hot(self, text: str, vector: List[float]):
+        self._hot.append((text, _normalize(np.asarray(vector, dtype=np.float32)), _tokens(text)))
+        self._hot_matrix = None
+
+    def search(self, query: List[float], limit: int = 5, category: Optional[str] = None) -> List[Tuple[float, str]]:
+        """Return up to ``limit`` (score, text) pairs by cosine similarity, best first."""
+        q = _normalize(np.asarray(query, dtype=np.float32))
+        scores = (self.matrix @ q) * self.scale
+        candidates = [(float(score), text) for score, text in self._top_k(scores, self.texts, limit, self._mask(category) if category else None)]
+        if self._hot:
+            if self._hot_matrix is None:
+                self._hot_matrix = np.stack([vector for _, vector, _ in self._hot])
+            hot_texts = [text for text, _, _ in self._hot]
+            needle = _tokens(category) if category else None
+            hot_mask = np.fromiter((needle <= tokens for _, _, tokens in self._hot), dtype=bool, count=len(hot_texts)) if category else None
+            candidates += self._top_k(self._hot_matrix @ q, hot_texts, limit, hot_mask)
+        return sorted(candidates, key=lambda hit: hit[0], reverse=True)[:limit]
+
+    @staticmethod
+    def _top_k(scores: np.ndarray, texts: List[str], limit: int, mask: Optional[np.ndarray]) -> List[Tuple[float, str]]:
+        if mask is not None:
+            scores = np.where(mask, scores, -np.inf)
+        k = min(limit, len(texts))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        return [(float(scores[i]), texts[i]) for i in top if np.isfinite(scores[i])]
+
+local_indexes: Dict[str, LocalVectorIndex] = {}
+
+def index_path(task: str, fingerprint: str) -> str:
+    return os.path.join(LOCAL_INDEX_DIR, f"{task}-{fingerprint[:16]}-{LOCAL_INDEX_DTYPE}.npy")
@@ -1,15 +1,27 @@
 import asyncio
-from fastapi import FastAPI, HTTPException, BackgroundTasks
-from pydantic import BaseModel
+import threading
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Request
+from fastapi.responses import JSONResponse, StreamingResponse, Response
+from starlette.routing import Match
+from starlette.background import BackgroundTask
+from pydantic import BaseModel, model_validator
 from typing import List, Dict, Optional
 from enum import Enum
 import redis.asyncio as redis
 from celery import Celery
+from celery.signals import worker_process_init, worker_process_shutdown
 from datetime import datetime
+import json
+import uuid
 from contextlib import asynccontextmanager
-from .nlp_tasks import process_nlp_task
-from .rag import retrieve_similar_docs, rerank_results, update_vector_db, check_qdrant_data, initialize_qdrant_collections
-from .utils import notify_webhook
+from .nlp_tasks import process_nlp_batch, process_multi_task, stream_chat_completion, build_prompt, parse_task_content, CHAT_MODEL
+from .rag import embed_text, embedding_batcher, semantic_cache, retrieve_similar_docs, rerank_results, update_vector_db, vector_write_buffer, check_qdrant_data, initialize_qdrant_collections, initialize_qdrant_client, initialize_local_indexes, close_qdrant_client
+from .webhooks import enqueue_webhook
+from .cache import ResultCache, make_cache_key
+from .clients import init_http_clients, close_http_clients
+from .singleflight import singleflight
+from .upstream import upstream_stats
+from .metrics import IN_FLIGHT, SERVER_TIMING_ENABLED, METRICS_CONTENT_TYPE, stage_timer, start_request_timings, finish_request_timings, server_timing_header, render_metrics
 import logging
 import os
 from dotenv import load_dotenv
@@ -23,6 +35,9 @@ logger = logging.getLogger(__name__)
 # Redis configuration
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
 redis_client = redis.from_url(REDIS_URL)
+result_cache = ResultCache(redis_client)
+TASK_STATUS_TTL = int(os.getenv("TASK_STATUS_TTL", 86400))
+TASK_STATUS_PREFIX = "nlp:task:"
 
 # Celery configuration
 celery_app = Celery(
@@ -42,13 +57,18 @@ celery_app.conf.update(
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     try:
+        await init_http_clients()
         await initialize_qdrant_collections()
         await check_qdrant_data()
+        vector_write_buffer.start()
         yield
     except Exception as e:
         logger.error(f"Failed to initialize Qdrant: {e}")
         raise
     finally:
+        await vector_write_buffer.stop()
+        await close_http_clients()
+        await close_qdrant_client()
         await redis_client.close()
         logger.info("Shutting down application...")
         logger.info("Shutdown complete.")
@@ -60,99 +80,357 @@ app = FastAPI(
     version="1.0.0"
 )
 
+def route_label(request: Request) -> str:
+    # Label by route template so /nlp/tasks/{task_id} doesn't create a series per task
+    for route in app.router.routes:
+        if route.matches(request.scope)[0] == Match.FULL:
+            return getattr(route, "path", request.url.path)
+    return "unmatched"
+
+@app.middleware("http")
+async def track_requests(request: Request, call_next):
+    endpoint = route_label(request)
+    token = start_request_timings()
+    IN_FLIGHT.labels(endpoint=endpoint).inc()
+    try:
+        with stage_timer("total"):
+            response = await call_next(request)
+    finally:
+        IN_FLIGHT.labels(endpoint=endpoint).dec()
+        timings = finish_request_timings(token)
+    # Streaming responses send headers first, so they only carry the stages before the first byte
+    if SERVER_TIMING_ENABLED and timings:
+        response.headers["Server-Timing"] = server_timing_header(timings)
+    return response
+
 class TaskType(str, Enum):
     CLASSIFY = "classify"
     EXTRACT_ENTITIES = "extract_entities"
     SUMMARIZE = "summarize"
     SENTIMENT = "sentiment"
 
+class ProcessingMode(str, Enum):
+    SYNC = "sync"
+    ASYNC = "async"
+
+class TaskStatus(str, Enum):
+    PENDING = "pending"
+    RUNNING = "running"
+    COMPLETED = "completed"
+    FAILED = "failed"
+
 class NLPRequest(BaseModel):
     text: str
-    task: TaskType
+    task: Optional[TaskType] = None
+    tasks: Optional[List[TaskType]] = None
     batch: Optional[List[str]] = None
     webhook_url: Optional[str] = None
     categories: List[str] = ["infectious", "chronic", "other"]
+    mode: ProcessingMode = ProcessingMode.SYNC
+
+    @model_validator(mode="after")
+    def check_tasks(self):
+        if self.tasks:
+            if self.batch:
+                raise ValueError("'tasks' cannot be combined with 'batch'")
+            self.tasks = list(dict.fromkeys(self.tasks))
+        elif self.task is None:
+            raise ValueError("Either 'task' or 'tasks' is required")
+        return self
+
+    def task_list(self) -> List[str]:
+        return [task.value for task in self.tasks] if self.tasks else [self.task.value]
 
 class TaskResult(BaseModel):
     task_id: str
-    result: Dict
-    completed_at: str
+    status: TaskStatus = TaskStatus.COMPLETED
+    result: Optional[Dict] = None
+    completed_at: Optional[str] = None
     related_docs: Optional[List[str]] = None
+    error: Optional[str] = None
 
-@celery_app.task
-def process_nlp_task_background(task_id: str, text: str, task: str, categories: Optional[List[str]], webhook_url: Optional[str]):
-    result = asyncio.run(process_nlp_task(text, task, categories))
+def new_task_id() -> str:
+    return f"task_{uuid.uuid4().hex}"
+
+async def set_task_status(task_id: str, status: TaskStatus, result: Optional[Dict] = None, error: Optional[str] = None):
+    record = {
+        "task_id": task_id,
+        "status": status.value,
+        "result": result,
+        "completed_at": datetime.now().isoformat() if status in (TaskStatus.COMPLETED, TaskStatus.FAILED) else None,
+        "related_docs": result.get("related_docs") if result else None,
+        "error": error,
+    }
+    await redis_client.setex(f"{TASK_STATUS_PREFIX}{task_id}", TASK_STATUS_TTL, json.dumps(record))
+
+async def embed_query(text: str) -> Optional[List[float]]:
+    try:
+        return await embed_text(text)
+    except Exception as e:
+        logger.error(f"Query embedding failed: {e}")
+        return None
+
+async def retrieve_and_rerank(text: str, task: str, categories: Optional[List[str]], query_embedding: Optional[List[float]]) -> List[str]:
+    if query_embedding is None:
+        return []
     category_hint = categories[0] if task == "classify" and categories else None
-    similar_docs = asyncio.run(retrieve_similar_docs(task, text, category=category_hint))
-    reranked_docs = asyncio.run(rerank_results(task, similar_docs, text))
-    result["related_docs"] = reranked_docs
-    asyncio.run(update_vector_db(task, text, result))
-    asyncio.run(redis_client.setex(f"{task_id}_{task}", 3600, str(result)))
+    similar_docs = await retrieve_similar_docs(task, text, category=category_hint, query_embedding=query_embedding)
+    return await rerank_results(task, similar_docs, text)
+
+def task_categories(task: str, categories: Optional[List[str]]) -> Optional[List[str]]:
+    return categories if task == TaskType.CLASSIFY.value else None
+
+async def run_multi(text: str, tasks: List[str], categories: Optional[List[str]]) -> Dict[str, Dict]:
+    """Run one or more tasks over a text: one LLM call, one query embedding, concurrent searches."""
+    tasks = [str(getattr(task, "value", task)) for task in tasks]
+    cached, query_embedding = {}, None
+    if semantic_cache.enabled:
+        # The LLM call can only be skipped if the embedding comes first
+        query_embedding = await embed_query(text)
+        if query_embedding is not None:
+            hits = await asyncio.gather(*(semantic_cache.lookup(task, query_embedding, task_categories(task, categories)) for task in tasks))
+            cached = {task: hit for task, hit in zip(tasks, hits) if hit is not None}
+    remaining = [task for task in tasks if task not in cached]
+    if not remaining:
+        return cached
+
+    async def retrieve_all() -> tuple:
+        embedding = query_embedding if query_embedding is not None else await embed_query(text)
+        docs = await asyncio.gather(*(retrieve_and_rerank(text, task, categories, embedding) for task in remaining))
+        return dict(zip(remaining, docs)), embedding
+
+    # Retrieval doesn't depend on the LLM output, so overlap the two
+    results, (related_docs, embedding) = await asyncio.gather(
+        process_multi_task(text, remaining, categories),
+        retrieve_all()
+    )
+    for task in remaining:
+        results[task]["related_docs"] = related_docs[task]
+        await update_vector_db(task, text, results[task], embedding=embedding, categories=task_categories(task, categories))
+    return {**cached, **results}
+
+async def run_single(text: str, task: str, categories: Optional[List[str]]) -> Dict:
+    return (await run_multi(text, [task], categories))[str(getattr(task, "value", task))]
+
+async def run_batch(batch: List[str], task: str, categories: Optional[List[str]]) -> tuple:
+    results = await process_nlp_batch(batch, task, categories)
+    failed = any(isinstance(r, Exception) for r in results)
+    results = [{"error": str(r)} if isinstance(r, Exception) else r for r in results]
+    return {"batch_results": dict(zip(batch, results))}, failed
+
+_worker_state = threading.local()
+
+def run_in_worker_loop(coro):
+    """Run a coroutine on this thread's persistent loop so pooled HTTP clients survive across tasks."""
+    loop = getattr(_worker_state, "loop", None)
+    if loop is None or loop.is_closed():
+        loop = asyncio.new_event_loop()
+        _worker_state.loop = loop
+    return loop.run_until_complete(coro)
+
+@worker_process_init.connect
+def init_worker_clients(**kwargs):
+    run_in_worker_loop(initialize_qdrant_client())
+    run_in_worker_loop(initialize_local_indexes())
+
+@worker_process_shutdown.connect
+def close_worker_loop(**kwargs):
+    loop = getattr(_worker_state, "loop", None)
+    if loop is not None and not loop.is_closed():
+        loop.run_until_complete(close_http_clients())
+        loop.run_until_complete(close_qdrant_client())
+        loop.close()
+
+async def run_request(text: str, tasks: List[str], categories: Optional[List[str]], batch: Optional[List[str]] = None) -> tuple:
+    if batch:
+        return await run_batch(batch, tasks[0], categories)
+    if len(tasks) > 1:
+        return await run_multi(text, tasks, categories), False
+    return await run_single(text, tasks[0], categories), False
+
+def cache_key_for(text: str, tasks: List[str], categories: Optional[List[str]], batch: Optional[List[str]] = None) -> str:
+    return make_cache_key("+".join(sorted(tasks)), text, categories, CHAT_MODEL, batch=batch)
+
+async def run_pipeline(task_id: str, text: str, tasks: List[str], categories: Optional[List[str]], webhook_url: Optional[str], batch: Optional[List[str]] = None) -> Dict:
+    await set_task_status(task_id, TaskStatus.RUNNING)
+    try:
+        result, failed = await run_request(text, tasks, categories, batch)
+    except Exception as e:
+        logger.error(f"Task {task_id} failed: {e}")
+        await set_task_status(task_id, TaskStatus.FAILED, error=str(e))
+        raise
+    # No background flusher runs between Celery tasks, so write learned points now
+    await vector_write_buffer.flush()
+    if not failed:
+        await result_cache.set(cache_key_for(text, tasks, categories, batch), result)
+    await set_task_status(task_id, TaskStatus.COMPLETED, result=result)
     if webhook_url:
-        asyncio.run(notify_webhook(webhook_url, {
+        await enqueue_webhook(webhook_url, {
             "task_id": task_id,
             "result": result,
             "completed_at": datetime.now().isoformat()
-        }))
+        })
     return result
 
+@celery_app.task
+def process_nlp_task_background(task_id: str, text: str, tasks: List[str], categories: Optional[List[str]], webhook_url: Optional[str], batch: Optional[List[str]] = None):
+    return run_in_worker_loop(run_pipeline(task_id, text, tasks, categories, webhook_url, batch))
+
 @app.post("/nlp/unified", response_model=TaskResult)
 async def unified_nlp(request: NLPRequest, background_tasks: BackgroundTasks):
-    task_id = f"task_{datetime.now().strftime('%Y%m%d%H%M%S')}"
-    cache_key = f"{task_id}_{request.task}"
-    
-    # Check Redis cache
-    cached_result = await redis_client.get(cache_key)
-    if cached_result:
-        return TaskResult(
-            task_id=task_id,
-            result=eval(cached_result),
-            completed_at=datetime.now().isoformat()
-        )
+    task_id = new_task_id()
+    tasks = request.task_list()
+    categories = request.categories if TaskType.CLASSIFY.value in tasks else None
+    cache_key = cache_key_for(request.text, tasks, categories, request.batch)
 
-    try:
-        if request.batch:
-            tasks = [process_nlp_task(text, request.task, request.categories if request.task == TaskType.CLASSIFY else None) for text in request.batch]
-            results = await asyncio.gather(*tasks, return_exceptions=True)
-            result = {"batch_results": dict(zip(request.batch, results))}
-            await redis_client.setex(cache_key, 3600, str(result))
+    # Check result cache (local LRU, then Redis)
+    cached_result = await result_cache.get(cache_key)
+    if cached_result is not None:
+        if request.mode == ProcessingMode.ASYNC:
+            # The task_id must still resolve via /nlp/tasks and reach the webhook like a queued task
+            try:
+                await set_task_status(task_id, TaskStatus.COMPLETED, result=cached_result)
+            except Exception as e:
+                logger.error(f"Failed to record cached task {task_id}: {e}")
+                raise HTTPException(status_code=503, detail=f"Failed to record task: {str(e)}")
             if request.webhook_url:
-                background_tasks.add_task(notify_webhook, request.webhook_url, {
+                background_tasks.add_task(enqueue_webhook, request.webhook_url, {
                     "task_id": task_id,
-                    "result": result,
+                    "result": cached_result,
                     "completed_at": datetime.now().isoformat()
                 })
-            return TaskResult(
-                task_id=task_id,
-                result=result,
-                completed_at=datetime.now().isoformat()
-            )
-        else:
-            background_tasks.add_task(
-                process_nlp_task_background,
+        return TaskResult(
+            task_id=task_id,
+            result=cached_result,
+            completed_at=datetime.now().isoformat(),
+            related_docs=cached_result.get("related_docs")
+        )
+
+    if request.mode == ProcessingMode.ASYNC:
+        try:
+            await set_task_status(task_id, TaskStatus.PENDING)
+            # Publishing to the broker is blocking I/O; keep it off the event loop
+            await asyncio.to_thread(
+                process_nlp_task_background.delay,
                 task_id,
                 request.text,
-                request.task,
-                request.categories if request.task == TaskType.CLASSIFY else None,
-                request.webhook_url
-            )
-            result = await process_nlp_task(request.text, request.task, request.categories if request.task == TaskType.CLASSIFY else None)
-            category_hint = request.categories[0] if request.task == TaskType.CLASSIFY and request.categories else None
-            similar_docs = await retrieve_similar_docs(request.task, request.text, category=category_hint)
-            reranked_docs = await rerank_results(request.task, similar_docs, request.text)
-            result["related_docs"] = reranked_docs
-            await update_vector_db(request.task, request.text, result)
-            await redis_client.setex(cache_key, 3600, str(result))
-            return TaskResult(
-                task_id=task_id,
-                result=result,
-                completed_at=datetime.now().isoformat(),
-                related_docs=reranked_docs
+                tasks,
+                categories,
+                request.webhook_url,
+                request.batch
             )
+        except Exception as e:
+            logger.error(f"Failed to enqueue task {task_id}: {e}")
+            raise HTTPException(status_code=503, detail=f"Failed to enqueue task: {str(e)}")
+        return JSONResponse(
+            status_code=202,
+            content=TaskResult(task_id=task_id, status=TaskStatus.PENDING).model_dump(mode="json")
+        )
+
+    try:
+        result, failed = await run_request(request.text, tasks, categories, request.batch)
+        related_docs = result.get("related_docs") if not request.batch and len(tasks) == 1 else None
+        if not failed:
+            await result_cache.set(cache_key, result)
+        if request.webhook_url:
+            background_tasks.add_task(enqueue_webhook, request.webhook_url, {
+                "task_id": task_id,
+                "result": result,
+                "completed_at": datetime.now().isoformat()
+            })
+        return TaskResult(
+            task_id=task_id,
+            result=result,
+            completed_at=datetime.now().isoformat(),
+            related_docs=related_docs
+        )
     except Exception as e:
         logger.error(f"Processing failed: {e}")
         raise HTTPException(status_code=500, detail=f"Processing failed: {str(e)}")
 
+def sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.post("/nlp/stream")
+async def stream_nlp(request: NLPRequest):
+    """Stream LLM tokens as Server-Sent Events, then the related docs and the parsed result."""
+    tasks = request.task_list()
+    if request.batch or len(tasks) > 1:
+        raise HTTPException(status_code=400, detail="Streaming supports a single text and a single task")
+    task = tasks[0]
+    task_id = new_task_id()
+    categories = request.categories if task == TaskType.CLASSIFY.value else None
+    cache_key = cache_key_for(request.text, tasks, categories)
+    final = {}
+
+    async def events():
+        yield sse_event("task", {"task_id": task_id})
+        cached_result = await result_cache.get(cache_key)
+        if cached_result is not None:
+            yield sse_event("related_docs", cached_result.get("related_docs") or [])
+            final["result"] = cached_result
+            yield sse_event("result", cached_result)
+            return
+
+        async def retrieve():
+            query_embedding = await embed_query(request.text)
+            return await retrieve_and_rerank(request.text, task, categories, query_embedding), query_embedding
+
+        retrieval = asyncio.create_task(retrieve())
+        chunks = []
+        try:
+            async for delta in stream_chat_completion(build_prompt(request.text, task, categories)):
+                chunks.append(delta)
+                yield sse_event("token", delta)
+            result = parse_task_content("".join(chunks), task)
+            related_docs, query_embedding = await retrieval
+            yield sse_event("related_docs", related_docs)
+            result["related_docs"] = related_docs
+            await update_vector_db(task, request.text, result, embedding=query_embedding, categories=categories)
+            await result_cache.set(cache_key, result)
+            final["result"] = result
+            yield sse_event("result", result)
+        except Exception as e:
+            retrieval.cancel()
+            logger.error(f"Streaming failed: {e}")
+            yield sse_event("error", {"detail": str(getattr(e, "detail", e))})
+
+    async def notify():
+        if request.webhook_url and "result" in final:
+            await enqueue_webhook(request.webhook_url, {
+                "task_id": task_id,
+                "result": final["result"],
+                "completed_at": datetime.now().isoformat()
+            })
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=BackgroundTask(notify)
+    )
+
+@app.get("/nlp/tasks/{task_id}", response_model=TaskResult)
+async def get_task_status(task_id: str):
+    record = await redis_client.get(f"{TASK_STATUS_PREFIX}{task_id}")
+    if record is None:
+        raise HTTPException(status_code=404, detail=f"Task {task_id} not found")
+    return TaskResult(**json.loads(record))
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return {
+        **result_cache.get_stats(),
+        "semantic": semantic_cache.get_stats(),
+        "singleflight": singleflight.stats,
+        "embedding_batches": embedding_batcher.stats,
+        "upstreams": upstream_stats()
+    }
+
+@app.get("/metrics")
+async def metrics():
+    return Response(render_metrics(), media_type=METRICS_CONTENT_TYPE)
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000, workers=4)
\ No newline at end of file
@@ -0,0 +1,76 @@
+import contextvars
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+from dotenv import load_dotenv
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client import multiprocess
+
+load_dotenv()
+SERVER_TIMING_ENABLED = os.getenv("SERVER_TIMING_ENABLED", "true").lower() == "true"
+# Set PROMETHEUS_MULTIPROC_DIR when running several uvicorn workers so /metrics aggregates them
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+STAGE_LATENCY = Histogram(
+    "nlp_stage_latency_seconds",
+    "Latency of each pipeline stage",
+    ["stage"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+)
+UPSTREAM_CALLS = Counter("nlp_upstream_calls_total", "Calls to upstream services", ["upstream", "outcome"])
+FALLBACKS = Counter("nlp_fallbacks_total", "Degraded results returned instead of failing", ["kind"])
+CACHE_LOOKUPS = Counter("nlp_cache_lookups_total", "Cache lookups by cache and result", ["cache", "result"])
+IN_FLIGHT = Gauge("nlp_in_flight_requests", "Requests currently being handled", ["endpoint"], multiprocess_mode="livesum")
+UPSTREAM_LIMIT = Gauge("nlp_upstream_concurrency_limit", "Adaptive concurrency limit per upstream", ["upstream"], multiprocess_mode="liveall")
+
+_request_timings: contextvars.ContextVar[Optional[Dict[str, float]]] = contextvars.ContextVar("request_timings", default=None)
+
+@contextmanager
+def stage_timer(stage: str):
+    """Observe a stage's duration and record it for the current request's Server-Timing header."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_LATENCY.labels(stage=stage).observe(elapsed)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + elapsed
+
+def record_upstream(upstream: str, outcome: str):
+    UPSTREAM_CALLS.labels(upstream=upstream, outcome=outcome).inc()
+
+def record_fallback(kind: str):
+    FALLBACKS.labels(kind=kind).inc()
+
+def record_cache(cache: str, result: str):
+    CACHE_LOOKUPS.labels(cache=cache, result=result).inc()
+
+def start_request_timings() -> contextvars.Token:
+    return _request_timings.set({})
+
+def finish_request_timings(token: contextvars.Token) -> Dict[str, float]:
+    timings = _request_timings.get() or {}
+    _request_timings.reset(token)
+    return timings
+
+def server_timing_header(timings: Dict[str, float]) -> str:
+    # Concurrent stages overlap, so the durations don't add up to the total
+    return ", ".join(f"{stage};dur={elapsed * 1000:.1f}" for stage, elapsed in timings.items())
+
+def render_metrics() -> bytes:
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest()
+
+METRICS_CONTENT_TYPE = CONTENT_TYPE_LATEST
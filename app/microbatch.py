@@ -0,0 +1,74 @@
+import asyncio
+import logging
+import os
+from typing import Any, Awaitable, Callable, List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", 32))
+EMBED_BATCH_WAIT = float(os.getenv("EMBED_BATCH_WAIT", 0.005))
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+class MicroBatcher:
+    """Collect single items from concurrent coroutines and process them in one call.
+
+    A batch is sent when ``max_batch`` items are waiting or ``max_wait`` seconds after
+    its first item arrived, whichever comes first. ``fn`` takes a list of items and
+    returns results in the same order; a failure is raised to every caller in the batch.
+    """
+
+    def __init__(self, fn: Callable[[List[Any]], Awaitable[List[Any]]], max_batch: int = EMBED_BATCH_SIZE, max_wait: float = EMBED_BATCH_WAIT):
+        self.fn = fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._pending: List[Tuple[Any, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._inflight = set()
+        self.stats = {"items": 0, "batches": 0}
+
+    async def submit(self, item: Any) -> Any:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.max_batch:
+            self._dispatch()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._dispatch)
+        return await future
+
+    def _dispatch(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+        if self._pending:
+            self._timer = asyncio.get_running_loop().call_later(self.max_wait, self._dispatch)
+        if not batch:
+            return
+        task = asyncio.get_running_loop().create_task(self._run(batch))
+        self._inflight.add(task)
+        task.add_done_callback(self._inflight.discard)
+
+    async def _run(self, batch: List[Tuple[Any, asyncio.Future]]):
+        # Identical items in one window are sent once
+        unique = list(dict.fromkeys(item for item, _ in batch))
+        self.stats["items"] += len(batch)
+        self.stats["batches"] += 1
+        try:
+            outputs = await self.fn(unique)
+            if len(outputs) != len(unique):
+                raise ValueError(f"Expected {len(unique)} results, got {len(outputs)}")
+            results = dict(zip(unique, outputs))
+        except Exception as e:
+            logger.error(f"Micro-batch of {len(unique)} items failed: {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for item, future in batch:
+            if not future.done():
+                future.set_result(results[item])
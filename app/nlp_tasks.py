@@ -1,68 +1,355 @@
+import asyncio
+import time
 import httpx
 import os
 import json
 import re
 from dotenv import load_dotenv
-from typing import Dict, List, Optional
+from typing import AsyncIterator, Dict, List, Optional
 from fastapi import HTTPException
+from .upstream import get_upstream, CircuitOpenError
+from .singleflight import singleflight, flight_key
+from .cache import ResultCache, make_cache_key
+from .utils import split_text
+from .metrics import stage_timer, record_upstream, record_fallback, STAGE_LATENCY, FALLBACKS
+import redis.asyncio as redis
 import logging
 
 load_dotenv()
 API_KEY = os.getenv("API_KEY")
-BASE_URL_CHAT = "https://api.us.inc/usf/v1/hiring"
+BASE_URL_CHAT = os.getenv("BASE_URL_CHAT", "https://api.us.inc/usf/v1/hiring")
+CHAT_MODEL = os.getenv("CHAT_MODEL", "usf1-mini")
+BATCH_PACK_SIZE = int(os.getenv("BATCH_PACK_SIZE", 8))
+BATCH_PACK_MAX_CHARS = int(os.getenv("BATCH_PACK_MAX_CHARS", 4000))
+BATCH_TOKENS_PER_ITEM = int(os.getenv("BATCH_TOKENS_PER_ITEM", 256))
+BATCH_PACK_MAX_TOKENS = int(os.getenv("BATCH_PACK_MAX_TOKENS", 4096))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", 8))
+SUMMARY_CHUNK_CHARS = int(os.getenv("SUMMARY_CHUNK_CHARS", 3000))
+SUMMARY_CHUNK_OVERLAP = int(os.getenv("SUMMARY_CHUNK_OVERLAP", 200))
+SUMMARY_CONCURRENCY = int(os.getenv("SUMMARY_CONCURRENCY", 4))
+SUMMARY_CACHE_TTL = int(os.getenv("SUMMARY_CACHE_TTL", 7 * 86400))
+SUMMARY_MAX_REDUCE_DEPTH = 3
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Chunk summaries live longer than request results: documents are re-submitted after small edits
+summary_chunk_cache = ResultCache(redis.from_url(REDIS_URL), ttl=SUMMARY_CACHE_TTL, name="summary_chunk")
+
 async def process_nlp_task(text: str, task: str, categories: Optional[List[str]] = None) -> Dict:
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        headers = {"x-api-key": API_KEY, "Content-Type": "application/json"}
-        prompt = ""
-        if task == "classify":
-            prompt = f"Classify '{text}' as a medical condition into {categories}. Return JSON with 'category' and 'confidence' (0-1)."
-        elif task == "extract_entities":
-            prompt = f"Extract entities from '{text}'. Return JSON with 'entities' as a list."
-        elif task == "summarize":
-            prompt = f"Summarize '{text}'. Return JSON with 'summary'."
-        elif task == "sentiment":
-            prompt = f"Determine the sentiment of '{text}'. Return JSON with 'sentiment' ('positive', 'negative', 'neutral') and 'score' (0-1)."
-
-        payload = {
-            "model": "usf1-mini",
-            "messages": [{"role": "user", "content": prompt}],
-            "temperature": 0.1,
-            "stream": False,
-            "max_tokens": 1024
-        }
+    # Concurrent identical requests share one chat completion
+    key = flight_key("chat", task, text, categories, CHAT_MODEL)
+    if task == "summarize" and len(text) > SUMMARY_CHUNK_CHARS:
+        return await singleflight.do(key, lambda: summarize_long(text))
+    return await singleflight.do(key, lambda: _process_nlp_task(text, task, categories))
 
-        try:
-            response = await client.post(f"{BASE_URL_CHAT}/chat/completions", json=payload, headers=headers)
-            response.raise_for_status()
-            result_data = response.json()
-            content = result_data.get("choices", [{}])[0].get("message", {}).get("content", "")
-
-            if isinstance(content, str) and content.strip():
-                json_str = re.sub(r'^```json\n|\n```$', '', content, flags=re.MULTILINE).strip()
-                if json_str:
-                    return json.loads(json_str)
-                else:
-                    raise ValueError("No valid JSON found in content")
+def build_prompt(text: str, task: str, categories: Optional[List[str]] = None) -> str:
+    prompt = ""
+    if task == "classify":
+        prompt = f"Classify '{text}' as a medical condition into {categories}. Return JSON with 'category' and 'confidence' (0-1)."
+    elif task == "extract_entities":
+        prompt = f"Extract entities from '{text}'. Return JSON with 'entities' as a list."
+    elif task == "summarize":
+        prompt = f"Summarize '{text}'. Return JSON with 'summary'."
+    elif task == "sentiment":
+        prompt = f"Determine the sentiment of '{text}'. Return JSON with 'sentiment' ('positive', 'negative', 'neutral') and 'score' (0-1)."
+    return prompt
+
+def fallback_result(task: str) -> Optional[Dict]:
+    if task == "classify":
+        return {"category": "unknown", "confidence": 0.5}
+    elif task == "extract_entities":
+        return {"entities": []}
+    elif task == "summarize":
+        return {"summary": "No summary available"}
+    elif task == "sentiment":
+        return {"sentiment": "neutral", "score": 0.5}
+
+def strip_code_fence(content: str) -> str:
+    return re.sub(r'^```(?:json)?\n|\n```$', '', content, flags=re.MULTILINE).strip()
+
+async def chat_completion(prompt: str, max_tokens: int = 1024) -> str:
+    """Send one chat completion and return the message content."""
+    upstream = get_upstream("chat")
+    headers = {"x-api-key": API_KEY, "Content-Type": "application/json"}
+    payload = {
+        "model": CHAT_MODEL,
+        "messages": [{"role": "user", "content": prompt}],
+        "temperature": 0.1,
+        "stream": False,
+        "max_tokens": max_tokens
+    }
+    try:
+        with stage_timer("llm"):
+            response = await upstream.post(f"{BASE_URL_CHAT}/chat/completions", json=payload, headers=headers)
+        response.raise_for_status()
+        record_upstream("chat", "success")
+    except httpx.HTTPStatusError as e:
+        record_upstream("chat", "error")
+        logger.error(f"HTTP error: {e.response.status_code} - {e.response.text}")
+        raise HTTPException(status_code=e.response.status_code, detail="API request failed")
+    except CircuitOpenError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except Exception:
+        record_upstream("chat", "error")
+        raise
+    result_data = response.json()
+    return result_data.get("choices", [{}])[0].get("message", {}).get("content", "")
+
+async def stream_chat_completion(prompt: str, max_tokens: int = 1024) -> AsyncIterator[str]:
+    """Send a streaming chat completion and yield content deltas as they arrive."""
+    upstream = get_upstream("chat")
+    headers = {"x-api-key": API_KEY, "Content-Type": "application/json"}
+    payload = {
+        "model": CHAT_MODEL,
+        "messages": [{"role": "user", "content": prompt}],
+        "temperature": 0.1,
+        "stream": True,
+        "max_tokens": max_tokens
+    }
+    start = time.perf_counter()
+    try:
+        async with upstream.stream("POST", f"{BASE_URL_CHAT}/chat/completions", json=payload, headers=headers) as response:
+            STAGE_LATENCY.labels(stage="llm_first_byte").observe(time.perf_counter() - start)
+            record_upstream("chat_stream", "error" if response.is_error else "success")
+            if response.is_error:
+                body = await response.aread()
+                logger.error(f"HTTP error: {response.status_code} - {body.decode(errors='replace')}")
+                raise HTTPException(status_code=response.status_code, detail="API request failed")
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                try:
+                    chunk = json.loads(data)
+                except json.JSONDecodeError:
+                    logger.warning(f"Skipping malformed stream chunk: {data}")
+                    continue
+                delta = (chunk.get("choices") or [{}])[0].get("delta", {}).get("content")
+                if delta:
+                    yield delta
+    except CircuitOpenError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+def parse_task_content(content: str, task: str) -> Dict:
+    """Parse a completion's JSON content, falling back to the task's default result."""
+    try:
+        json_str = strip_code_fence(content or "")
+        if json_str:
+            return json.loads(json_str)
+        logger.warning("No valid JSON found in streamed content")
+    except json.JSONDecodeError as e:
+        logger.warning(f"Failed to parse JSON: {e}, Content: {content}")
+    record_fallback("json_parse")
+    return fallback_result(task)
+
+async def _process_nlp_task(text: str, task: str, categories: Optional[List[str]] = None) -> Dict:
+    content = ""
+    try:
+        content = await chat_completion(build_prompt(text, task, categories))
+
+        if isinstance(content, str) and content.strip():
+            json_str = strip_code_fence(content)
+            if json_str:
+                return json.loads(json_str)
             else:
-                raise ValueError("API returned invalid or empty content")
-        except httpx.HTTPStatusError as e:
-            logger.error(f"HTTP error: {e.response.status_code} - {e.response.text}")
-            raise HTTPException(status_code=e.response.status_code, detail="API request failed")
+                raise ValueError("No valid JSON found in content")
+        else:
+            raise ValueError("API returned invalid or empty content")
+    except HTTPException:
+        raise
+    except json.JSONDecodeError as e:
+        logger.warning(f"Failed to parse JSON: {e}, Content: {content}")
+        record_fallback("json_parse")
+        return fallback_result(task)
+    except Exception as e:
+        logger.error(f"Error processing response: {e}")
+        raise HTTPException(status_code=500, detail=f"Processing failed: {str(e)}")
+
+# Per-task wording for packed multi-text prompts: (instruction, fields to return)
+PACKED_TASK_SPECS = {
+    "classify": ("classify it as a medical condition into {categories}", ("category", "confidence"), "'category' and 'confidence' (0-1)"),
+    "extract_entities": ("extract its entities", ("entities",), "'entities' as a list"),
+    "summarize": ("summarize it", ("summary",), "'summary'"),
+    "sentiment": ("determine its sentiment", ("sentiment", "score"), "'sentiment' ('positive', 'negative', 'neutral') and 'score' (0-1)"),
+}
+
+def pack_texts(texts: List[str], pack_size: int = BATCH_PACK_SIZE, max_chars: int = BATCH_PACK_MAX_CHARS) -> List[List[str]]:
+    """Group texts into packs bounded by item count and total characters."""
+    packs, current, current_chars = [], [], 0
+    for text in texts:
+        if current and (len(current) >= pack_size or current_chars + len(text) > max_chars):
+            packs.append(current)
+            current, current_chars = [], 0
+        current.append(text)
+        current_chars += len(text)
+    if current:
+        packs.append(current)
+    return packs
+
+def build_packed_prompt(texts: List[str], task: str, categories: Optional[List[str]] = None) -> str:
+    instruction, _, fields = PACKED_TASK_SPECS[task]
+    numbered = "\n".join(f"{i}. '{text}'" for i, text in enumerate(texts))
+    return (
+        f"For each numbered text below, {instruction.format(categories=categories)}. "
+        f"Return only a JSON array with one object per text, each with 'index' (the text's number) and {fields}.\n\n{numbered}"
+    )
+
+def parse_packed_results(content: str, task: str, count: int) -> Dict[int, Dict]:
+    """Return the valid per-index results from a packed completion; invalid items are omitted."""
+    _, required, _ = PACKED_TASK_SPECS[task]
+    try:
+        data = json.loads(strip_code_fence(content or ""))
+    except json.JSONDecodeError as e:
+        logger.warning(f"Failed to parse packed JSON: {e}")
+        return {}
+    if isinstance(data, dict):
+        data = data.get("results", [])
+    if not isinstance(data, list):
+        return {}
+    parsed = {}
+    for item in data:
+        if not isinstance(item, dict):
+            continue
+        index = item.get("index")
+        if isinstance(index, str) and index.isdigit():
+            index = int(index)
+        if isinstance(index, int) and 0 <= index < count and index not in parsed and all(field in item for field in required):
+            parsed[index] = {k: v for k, v in item.items() if k != "index"}
+    return parsed
+
+async def process_nlp_batch(texts: List[str], task: str, categories: Optional[List[str]] = None,
+                            pack_size: int = BATCH_PACK_SIZE, concurrency: int = BATCH_CONCURRENCY) -> List:
+    """Run a task over many texts, packing several short texts into each completion.
+
+    Items missing or malformed in a packed response are retried one by one with
+    process_nlp_task; if the packed call itself fails, its items fail with that error.
+    Returns one result per input text, in order; an item that still fails is returned
+    as its exception, like ``gather(return_exceptions=True)``.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    unique = list(dict.fromkeys(texts))
+    results: Dict[str, object] = {}
+
+    async def run_single(text: str):
+        async with semaphore:
+            try:
+                results[text] = await process_nlp_task(text, task, categories)
+            except Exception as e:
+                results[text] = e
+
+    async def run_pack(pack: List[str]):
+        if len(pack) == 1:
+            await run_single(pack[0])
+            return
+        async with semaphore:
+            try:
+                content = await chat_completion(
+                    build_packed_prompt(pack, task, categories),
+                    max_tokens=min(BATCH_PACK_MAX_TOKENS, BATCH_TOKENS_PER_ITEM * len(pack))
+                )
+            except Exception as e:
+                # Retrying item by item after a 429 or an open circuit would only multiply the calls
+                logger.warning(f"Packed call for {len(pack)} texts failed: {e}")
+                for text in pack:
+                    results[text] = e
+                return
+            parsed = parse_packed_results(content, task, len(pack))
+        for i, text in enumerate(pack):
+            if i in parsed:
+                results[text] = parsed[i]
+        missing = [text for i, text in enumerate(pack) if i not in parsed]
+        if missing:
+            logger.info(f"Falling back to per-item calls for {len(missing)} of {len(pack)} packed texts")
+            FALLBACKS.labels(kind="packed_item").inc(len(missing))
+            await asyncio.gather(*(run_single(text) for text in missing))
+
+    await asyncio.gather(*(run_pack(pack) for pack in pack_texts(unique, pack_size)))
+    return [results[text] for text in texts]
+
+def build_multi_task_prompt(text: str, tasks: List[str], categories: Optional[List[str]] = None) -> str:
+    lines = []
+    for task in tasks:
+        instruction, _, fields = PACKED_TASK_SPECS[task]
+        lines.append(f"- '{task}': {instruction.format(categories=categories)}; an object with {fields}")
+    keys = "\n".join(lines)
+    return f"Analyze the text '{text}'. Return only one JSON object with these keys:\n{keys}"
+
+async def process_multi_task(text: str, tasks: List[str], categories: Optional[List[str]] = None) -> Dict[str, Dict]:
+    """Run several tasks over one text with a single combined completion.
+
+    Tasks missing or malformed in the combined response fall back to their own
+    process_nlp_task call.
+    """
+    tasks = [str(getattr(task, "value", task)) for task in tasks]
+    if "summarize" in tasks and len(text) > SUMMARY_CHUNK_CHARS and len(tasks) > 1:
+        # Long text: summarize via map-reduce alongside the combined call for the rest
+        others = [task for task in tasks if task != "summarize"]
+        summary, results = await asyncio.gather(
+            process_nlp_task(text, "summarize"),
+            process_multi_task(text, others, categories)
+        )
+        return {**results, "summarize": summary}
+    if len(tasks) == 1:
+        return {tasks[0]: await process_nlp_task(text, tasks[0], categories)}
+
+    async def combined() -> Dict:
+        try:
+            content = await chat_completion(build_multi_task_prompt(text, tasks, categories))
+            data = json.loads(strip_code_fence(content or ""))
         except json.JSONDecodeError as e:
-            logger.warning(f"Failed to parse JSON: {e}, Content: {content}")
-            if task == "classify":
-                return {"category": "unknown", "confidence": 0.5}
-            elif task == "extract_entities":
-                return {"entities": []}
-            elif task == "summarize":
-                return {"summary": "No summary available"}
-            elif task == "sentiment":
-                return {"sentiment": "neutral", "score": 0.5}
-        except Exception as e:
-            logger.error(f"Error processing response: {e}")
-            raise HTTPException(status_code=500, detail=f"Processing failed: {str(e)}")
\ No newline at end of file
+            logger.warning(f"Failed to parse multi-task JSON: {e}")
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    data = await singleflight.do(flight_key("chat-multi", sorted(tasks), text, categories, CHAT_MODEL), combined)
+    results = {}
+    for task in tasks:
+        _, required, _ = PACKED_TASK_SPECS[task]
+        value = data.get(task)
+        if isinstance(value, dict) and all(field in value for field in required):
+            results[task] = value
+    missing = [task for task in tasks if task not in results]
+    if missing:
+        logger.info(f"Falling back to per-task calls for {missing}")
+        FALLBACKS.labels(kind="multi_task_item").inc(len(missing))
+        fallbacks = await asyncio.gather(*(process_nlp_task(text, task, categories) for task in missing))
+        results.update(zip(missing, fallbacks))
+    return results
+
+
+async def summarize_chunk(chunk: str, semaphore: asyncio.Semaphore) -> str:
+    key = make_cache_key("summarize_chunk", chunk, None, CHAT_MODEL)
+    cached = await summary_chunk_cache.get(key)
+    if cached is not None:
+        return cached["summary"]
+    async with semaphore:
+        result = await _process_nlp_task(chunk, "summarize")
+    summary = str(result.get("summary", ""))
+    if result != fallback_result("summarize"):
+        await summary_chunk_cache.set(key, {"summary": summary})
+    return summary
+
+async def summarize_long(text: str, depth: int = 0) -> Dict:
+    """Map-reduce summary for text longer than SUMMARY_CHUNK_CHARS.
+
+    Chunks are split on paragraph/sentence boundaries with overlap and summarized
+    concurrently. Chunk summaries are cached by content hash, so an edited document
+    only re-summarizes the chunks that changed. Partial summaries are then reduced,
+    recursively if they are still too long.
+    """
+    chunks = split_text(text, SUMMARY_CHUNK_CHARS, SUMMARY_CHUNK_OVERLAP)
+    semaphore = asyncio.Semaphore(SUMMARY_CONCURRENCY)
+    partials = await asyncio.gather(*(summarize_chunk(chunk, semaphore) for chunk in chunks))
+    logger.info(f"Summarized {len(chunks)} chunks at depth {depth}")
+    combined = "\n\n".join(partial for partial in partials if partial)
+    if len(combined) > SUMMARY_CHUNK_CHARS and depth + 1 < SUMMARY_MAX_REDUCE_DEPTH:
+        reduced = await summarize_long(combined, depth + 1)
+        return {"summary": reduced["summary"], "chunks": len(chunks)}
+    prompt = f"Combine these partial summaries of one document into a single summary: '{combined}'. Return JSON with 'summary'."
+    result = parse_task_content(await chat_completion(prompt), "summarize")
+    return {"summary": result.get("summary", ""), "chunks": len(chunks)}
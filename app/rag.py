@@ -1,50 +1,146 @@
-import nest_asyncio
-nest_asyncio.apply()
-
-from qdrant_client import QdrantClient
+from qdrant_client import AsyncQdrantClient
 from qdrant_client.http import models
 import asyncio
 import httpx
 import os
 import csv
 from dotenv import load_dotenv
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
+from collections import OrderedDict
+import time
 from fastapi import HTTPException
+from .upstream import get_upstream, CircuitOpenError
+from .utils import split_text
+from .nlp_tasks import CHAT_MODEL
+from .local_index import LocalVectorIndex, LOCAL_INDEX_ENABLED, local_indexes, index_path
+from .embedding_store import embedding_store, file_lock
+from .singleflight import singleflight, flight_key
+from .microbatch import MicroBatcher
+from .metrics import stage_timer, record_upstream, record_fallback, record_cache, FALLBACKS
 import logging
 import json
+import hashlib
+import uuid
 
 load_dotenv()
 API_KEY = os.getenv("API_KEY")
-BASE_URL_EMBED = "https://api.us.inc/usf/v1/embed"
-BASE_URL_RERANK = "https://api.us.inc/usf/v1/embed"
+BASE_URL_EMBED = os.getenv("BASE_URL_EMBED", "https://api.us.inc/usf/v1/embed")
+BASE_URL_RERANK = os.getenv("BASE_URL_RERANK", "https://api.us.inc/usf/v1/embed")
+EMBED_MODEL = os.getenv("EMBED_MODEL", "usf1-embed")
+CSV_CHUNK_OVERLAP = int(os.getenv("CSV_CHUNK_OVERLAP", 200))
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() == "true"
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.95))
+LOCAL_INDEX_MERGE_QDRANT = os.getenv("LOCAL_INDEX_MERGE_QDRANT", "false").lower() == "true"
+WRITE_BUFFER_SIZE = int(os.getenv("WRITE_BUFFER_SIZE", 64))
+WRITE_BUFFER_INTERVAL = float(os.getenv("WRITE_BUFFER_INTERVAL", 1.0))
+WRITE_BUFFER_MAX_PENDING = int(os.getenv("WRITE_BUFFER_MAX_PENDING", 10000))
+WRITE_BUFFER_MAX_BACKOFF = float(os.getenv("WRITE_BUFFER_MAX_BACKOFF", 30.0))
 QDRANT_URL = os.getenv("QDRANT_URL", "http://localhost:6333")
 
+# Collection tuning profile
+QDRANT_HNSW_M = int(os.getenv("QDRANT_HNSW_M", 16))
+QDRANT_HNSW_EF_CONSTRUCT = int(os.getenv("QDRANT_HNSW_EF_CONSTRUCT", 100))
+QDRANT_SEARCH_HNSW_EF = int(os.getenv("QDRANT_SEARCH_HNSW_EF", 128))
+QDRANT_QUANTIZATION = os.getenv("QDRANT_QUANTIZATION", "int8")  # "int8" or "none"
+QDRANT_RESCORE = os.getenv("QDRANT_RESCORE", "true").lower() == "true"
+QDRANT_OVERSAMPLING = float(os.getenv("QDRANT_OVERSAMPLING", 2.0))
+QDRANT_ON_DISK = os.getenv("QDRANT_ON_DISK", "false").lower() == "true"
+QDRANT_MIGRATE_COLLECTIONS = os.getenv("QDRANT_MIGRATE_COLLECTIONS", "true").lower() == "true"
+KEYWORD_PAYLOAD_FIELDS = ("category", "kind", "categories_key", "model")
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Initialize Qdrant client with fallback to HTTP
-def initialize_qdrant_client():
+# Async Qdrant client so searches and upserts don't block the event loop.
+# Construction doesn't connect; initialize_qdrant_client() probes gRPC and falls back to HTTP.
+# QDRANT_URL=":memory:" runs qdrant-client's in-process local mode (used by the benchmarks).
+if QDRANT_URL == ":memory:":
+    client = AsyncQdrantClient(location=":memory:")
+else:
+    client = AsyncQdrantClient(url=QDRANT_URL, prefer_grpc=True, timeout=10)
+
+async def initialize_qdrant_client():
+    global client
+    if QDRANT_URL == ":memory:":
+        return client
     try:
-        client = QdrantClient(
-            url=QDRANT_URL,
-            prefer_grpc=True,
-            timeout=10.0
-        )
         # Test gRPC connection
-        client.get_collections()
+        await client.get_collections()
         logger.info("Qdrant client initialized with gRPC")
-        return client
     except Exception as e:
         logger.warning(f"gRPC connection failed: {e}. Falling back to HTTP.")
-        client = QdrantClient(
-            url=QDRANT_URL,
-            prefer_grpc=False,
-            timeout=10.0
+        await client.close()
+        client = AsyncQdrantClient(url=QDRANT_URL, prefer_grpc=False, timeout=10)
+    return client
+
+async def close_qdrant_client():
+    await client.close()
+
+def hnsw_config() -> models.HnswConfigDiff:
+    return models.HnswConfigDiff(m=QDRANT_HNSW_M, ef_construct=QDRANT_HNSW_EF_CONSTRUCT, on_disk=QDRANT_ON_DISK)
+
+def quantization_config() -> Optional[models.ScalarQuantization]:
+    if QDRANT_QUANTIZATION != "int8":
+        return None
+    # Quantized vectors stay in RAM; originals (possibly on disk) are only read for rescoring
+    return models.ScalarQuantization(
+        scalar=models.ScalarQuantizationConfig(type=models.ScalarType.INT8, quantile=0.99, always_ram=True)
+    )
+
+def search_params() -> models.SearchParams:
+    return models.SearchParams(
+        hnsw_ef=QDRANT_SEARCH_HNSW_EF,
+        quantization=models.QuantizationSearchParams(rescore=QDRANT_RESCORE, oversampling=QDRANT_OVERSAMPLING) if QDRANT_QUANTIZATION == "int8" else None
+    )
+
+async def ensure_payload_indexes(task: str, existing=()) -> List[str]:
+    """Full-text index on `text` (used by the classify filter) and keyword indexes for exact-match fields.
+
+    Fields in ``existing`` are skipped; returns the fields that were indexed.
+    """
+    created = []
+    if "text" not in existing:
+        await client.create_payload_index(
+            collection_name=task,
+            field_name="text",
+            field_schema=models.TextIndexParams(
+                type=models.TextIndexType.TEXT,
+                tokenizer=models.TokenizerType.WORD,
+                lowercase=True
+            )
         )
-        return client
+        created.append("text")
+    for field in KEYWORD_PAYLOAD_FIELDS:
+        if field not in existing:
+            await client.create_payload_index(collection_name=task, field_name=field, field_schema=models.PayloadSchemaType.KEYWORD)
+            created.append(field)
+    return created
+
+def collection_profile_changes(config: models.CollectionConfig) -> Dict:
+    """The update_collection arguments needed to bring ``config`` in line with the tuning profile."""
+    changes = {}
+    hnsw = config.hnsw_config
+    if (hnsw.m, hnsw.ef_construct, bool(hnsw.on_disk)) != (QDRANT_HNSW_M, QDRANT_HNSW_EF_CONSTRUCT, QDRANT_ON_DISK):
+        changes["hnsw_config"] = hnsw_config()
+    vectors = config.params.vectors
+    if isinstance(vectors, models.VectorParams) and bool(vectors.on_disk) != QDRANT_ON_DISK:
+        changes["vectors_config"] = {"": models.VectorParamsDiff(on_disk=QDRANT_ON_DISK)}
+    if config.quantization_config != quantization_config():
+        changes["quantization_config"] = quantization_config() or models.Disabled.DISABLED
+    return changes
 
-client = initialize_qdrant_client()
+async def migrate_collection(task: str):
+    """Bring an existing collection in line with the current tuning profile, touching only what differs."""
+    info = await client.get_collection(task)
+    changes = collection_profile_changes(info.config)
+    if changes:
+        await client.update_collection(collection_name=task, **changes)
+    created = await ensure_payload_indexes(task, existing=info.payload_schema or {})
+    if changes or created:
+        logger.info(f"Updated collection {task}: settings {sorted(changes)}, new payload indexes {created}")
+    else:
+        logger.info(f"Collection {task} already matches the collection profile")
 
 async def create_qdrant_collections():
     """Create Qdrant collections if they don't exist, with error handling and retry."""
@@ -52,16 +148,22 @@ async def create_qdrant_collections():
         for attempt in range(3):  # Retry up to 3 times
             try:
                 # Check if collection exists
-                collections = client.get_collections().collections
+                collections = (await client.get_collections()).collections
                 if any(collection.name == task for collection in collections):
-                    logger.info(f"Collection {task} already exists, skipping creation")
+                    if QDRANT_MIGRATE_COLLECTIONS:
+                        await migrate_collection(task)
+                    else:
+                        logger.info(f"Collection {task} already exists, skipping creation")
                     break
-                client.recreate_collection(
+                await client.recreate_collection(
                     collection_name=task,
-                    vectors_config=models.VectorParams(size=1024, distance=models.Distance.COSINE),
+                    vectors_config=models.VectorParams(size=1024, distance=models.Distance.COSINE, on_disk=QDRANT_ON_DISK),
                     shard_number=2,
-                    replication_factor=2
+                    replication_factor=2,
+                    hnsw_config=hnsw_config(),
+                    quantization_config=quantization_config()
                 )
+                await ensure_payload_indexes(task)
                 logger.info(f"Created collection {task}")
                 break
             except Exception as e:
@@ -88,14 +190,11 @@ def initialize_from_csv(csv_path: str, limit: int = 200, max_length: int = 2000)
                 if not disease or not description:  # Skip empty strings
                     logger.warning(f"Skipping empty disease or description at row {count + 2}")
                     continue
-                classify_text = f"{disease}: {description[:max_length - len(disease) - 2]}" if len(description) > max_length - len(disease) - 2 else f"{disease}: {description}"
-                extract_text = description[:max_length] if len(description) > max_length else description
-                summarize_text = description[:max_length] if len(description) > max_length else description
-                sentiment_text = f"Information on {disease}: {description[:max_length - len(disease) - 15]}" if len(description) > max_length - len(disease) - 15 else f"Information on {disease}: {description}"
-                classify_data.append(classify_text)
-                extract_entities_data.append(extract_text)
-                summarize_data.append(summarize_text)
-                sentiment_data.append(sentiment_text)
+                # Long descriptions become several overlapping chunks instead of being truncated
+                classify_data.extend(f"{disease}: {chunk}" for chunk in split_text(description, max(max_length - len(disease) - 2, 1), CSV_CHUNK_OVERLAP))
+                extract_entities_data.extend(split_text(description, max_length, CSV_CHUNK_OVERLAP))
+                summarize_data.extend(split_text(description, max_length, CSV_CHUNK_OVERLAP))
+                sentiment_data.extend(f"Information on {disease}: {chunk}" for chunk in split_text(description, max(max_length - len(disease) - 15, 1), CSV_CHUNK_OVERLAP))
                 count += 1
             logger.info(f"Loaded {count} records from {csv_path}")
             return classify_data, extract_entities_data, summarize_data, sentiment_data
@@ -110,6 +209,7 @@ classify_texts, extract_entities_texts, summarize_texts, sentiment_texts = initi
 
 async def initialize_qdrant_collections():
     try:
+        await initialize_qdrant_client()
         await create_qdrant_collections()
         tasks = [
             get_embeddings_and_upsert("classify", classify_texts),
@@ -119,112 +219,400 @@ async def initialize_qdrant_collections():
         ]
         await asyncio.gather(*tasks)
         logger.info("Qdrant collections initialized successfully")
+        await initialize_local_indexes()
     except Exception as e:
         logger.error(f"Failed to initialize Qdrant collections: {e}")
         raise
 
+SEED_TEXTS = {
+    "classify": classify_texts,
+    "extract_entities": extract_entities_texts,
+    "summarize": summarize_texts,
+    "sentiment": sentiment_texts
+}
+
+async def build_local_index(task: str, texts: List[str]):
+    """Load the task's seed matrix from disk, or build it from the vectors already in Qdrant."""
+    path = index_path(task, corpus_fingerprint(task, texts))
+    index = await asyncio.to_thread(LocalVectorIndex.load, path)
+    if index is None:
+        points = await client.retrieve(collection_name=task, ids=list(range(len(texts))), with_payload=False, with_vectors=True)
+        if len(points) != len(texts):
+            logger.warning(f"{task} collection holds {len(points)} of {len(texts)} seed points, skipping local index")
+            return
+        vectors = [point.vector for point in sorted(points, key=lambda point: point.id)]
+        index = LocalVectorIndex.build(texts, vectors)
+        await asyncio.to_thread(index.save, path)
+    local_indexes[task] = index
+    logger.info(f"Local index for {task} ready with {len(texts)} seed vectors")
+
+async def initialize_local_indexes():
+    if not LOCAL_INDEX_ENABLED:
+        return
+    results = await asyncio.gather(*(build_local_index(task, texts) for task, texts in SEED_TEXTS.items()), return_exceptions=True)
+    for task, result in zip(SEED_TEXTS, results):
+        if isinstance(result, Exception):
+            logger.warning(f"Failed to build local index for {task}, using Qdrant only: {result}")
+
+def corpus_fingerprint(task: str, texts: List[str]) -> str:
+    digest = hashlib.sha256(f"{task}\0{EMBED_MODEL}\0".encode("utf-8"))
+    for text in texts:
+        digest.update(text.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+async def is_corpus_ingested(task: str, fingerprint: str, count: int) -> bool:
+    """True if every seed point is present and tagged with the current corpus fingerprint."""
+    if count == 0:
+        return True
+    points = await client.retrieve(
+        collection_name=task,
+        ids=list(range(count)),
+        with_payload=["corpus_fingerprint"],
+        with_vectors=False
+    )
+    return len(points) == count and all((p.payload or {}).get("corpus_fingerprint") == fingerprint for p in points)
+
+async def get_embeddings_cached(texts: List[str]) -> List[List[float]]:
+    """Embed texts through the on-disk store, calling the API only for misses."""
+    cached = await embedding_store.aget_many(texts, EMBED_MODEL)
+    missing = list(dict.fromkeys(text for text in texts if text not in cached))
+    if missing:
+        embeddings = await get_embeddings(missing)
+        await embedding_store.aput_many(missing, embeddings, EMBED_MODEL)
+        cached.update(zip(missing, embeddings))
+    logger.info(f"Embedding store: {len(texts) - len(missing)} hits, {len(missing)} misses")
+    return [cached[text] for text in texts]
+
 async def get_embeddings_and_upsert(task: str, texts: List[str]):
     try:
-        # Batch texts into chunks of 32 to respect API limits
-        batch_size = 32
-        for i in range(0, len(texts), batch_size):
-            batch_texts = texts[i:i + batch_size]
-            embeddings = await get_embeddings(batch_texts)
-            client.upsert(
-                collection_name=task,
-                points=models.Batch(
-                    ids=list(range(i, i + len(batch_texts))),
-                    payloads=[{"text": text} for text in batch_texts],
-                    vectors=embeddings
+        fingerprint = corpus_fingerprint(task, texts)
+        if await is_corpus_ingested(task, fingerprint, len(texts)):
+            logger.info(f"{task} collection already holds the current corpus, skipping ingestion")
+            return
+        # Only one worker on this host embeds and upserts; the others wait and then find it done
+        async with file_lock(f"ingest-{task}"):
+            if await is_corpus_ingested(task, fingerprint, len(texts)):
+                logger.info(f"{task} collection was ingested by another worker, skipping ingestion")
+                return
+            # Batch texts into chunks of 32 to respect API limits
+            batch_size = 32
+            for i in range(0, len(texts), batch_size):
+                batch_texts = texts[i:i + batch_size]
+                embeddings = await get_embeddings_cached(batch_texts)
+                await client.upsert(
+                    collection_name=task,
+                    points=models.Batch(
+                        ids=list(range(i, i + len(batch_texts))),
+                        payloads=[{"text": text, "corpus_fingerprint": fingerprint} for text in batch_texts],
+                        vectors=embeddings
+                    )
                 )
-            )
-            logger.info(f"Upserted {len(batch_texts)} points to {task} collection (batch {i//batch_size + 1})")
+                logger.info(f"Upserted {len(batch_texts)} points to {task} collection (batch {i//batch_size + 1})")
     except Exception as e:
         logger.error(f"Failed to upsert embeddings for {task}: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to upsert embeddings: {str(e)}")
 
 async def get_embeddings(texts: List[str]) -> List[List[float]]:
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        headers = {"x-api-key": API_KEY}
-        payload = {"model": "usf1-embed", "input": texts}
-        try:
-            response = await client.post(f"{BASE_URL_EMBED}/embeddings", json=payload, headers=headers)
-            response.raise_for_status()
-            embeddings = [emb["embedding"] for emb in response.json()["result"]["data"]]
-            if len(embeddings) > 0 and len(embeddings[0]) != 1024:
-                raise ValueError(f"Expected 1024D embeddings, got {len(embeddings[0])}D")
-            return embeddings
-        except httpx.HTTPStatusError as e:
-            logger.error(f"Embedding API error: {e.response.status_code} - {e.response.text}")
-            raise HTTPException(status_code=e.response.status_code, detail="Embedding API request failed")
-        except Exception as e:
-            logger.error(f"Embedding processing error: {e}")
-            raise HTTPException(status_code=500, detail=f"Embedding processing error: {str(e)}")
+    key = flight_key("embed", EMBED_MODEL, texts)
+    return await singleflight.do(key, lambda: _get_embeddings(texts))
+
+async def embed_text(text: str) -> List[float]:
+    """Embed one text via the micro-batcher, sharing an API call with concurrent callers."""
+    # Own namespace: get_embeddings([text]) returns a list of vectors, this returns one vector
+    key = flight_key("embed-one", EMBED_MODEL, text)
+    return await singleflight.do(key, lambda: embedding_batcher.submit(text))
 
-async def update_vector_db(task: str, prompt: str, result: Dict):
+async def _get_embeddings(texts: List[str]) -> List[List[float]]:
+    upstream = get_upstream("embed")
+    headers = {"x-api-key": API_KEY}
+    payload = {"model": EMBED_MODEL, "input": texts}
     try:
-        embedding = (await get_embeddings([f"{prompt} -> {json.dumps(result)}"]))[0]
-        point_id = client.count(collection_name=task).count
-        client.upsert(
-            collection_name=task,
-            points=models.Batch(
-                ids=[point_id],
-                payloads=[{"text": f"{prompt} -> {json.dumps(result)}"}],
-                vectors=[embedding]
-            )
-        )
-        logger.info(f"Updated vector DB for {task} with point ID {point_id}")
+        with stage_timer("embed"):
+            response = await upstream.post(f"{BASE_URL_EMBED}/embeddings", json=payload, headers=headers)
+        response.raise_for_status()
+        embeddings = [emb["embedding"] for emb in response.json()["result"]["data"]]
+        if len(embeddings) > 0 and len(embeddings[0]) != 1024:
+            raise ValueError(f"Expected 1024D embeddings, got {len(embeddings[0])}D")
+        record_upstream("embed", "success")
+        return embeddings
+    except httpx.HTTPStatusError as e:
+        record_upstream("embed", "error")
+        logger.error(f"Embedding API error: {e.response.status_code} - {e.response.text}")
+        raise HTTPException(status_code=e.response.status_code, detail="Embedding API request failed")
+    except CircuitOpenError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except Exception as e:
+        record_upstream("embed", "error")
+        logger.error(f"Embedding processing error: {e}")
+        raise HTTPException(status_code=500, detail=f"Embedding processing error: {str(e)}")
+
+embedding_batcher = MicroBatcher(_get_embeddings)
+
+def point_id_for(task: str, text: str) -> str:
+    """Deterministic content-hash point ID, so concurrent writers of the same text dedupe."""
+    return str(uuid.UUID(hashlib.sha256(f"{task}\0{text}".encode("utf-8")).hexdigest()[:32]))
+
+class VectorWriteBuffer:
+    """Write-behind buffer for learned points, flushed to Qdrant by size or interval.
+
+    Points are keyed by content-hash ID per task, so repeats within a window collapse
+    into one upsert and repeats across windows overwrite the same point. While Qdrant
+    is failing, flushes back off exponentially and the buffer keeps at most
+    ``max_pending`` points, dropping the oldest.
+    """
+
+    def __init__(self, max_size: int = WRITE_BUFFER_SIZE, interval: float = WRITE_BUFFER_INTERVAL,
+                 max_pending: int = WRITE_BUFFER_MAX_PENDING, max_backoff: float = WRITE_BUFFER_MAX_BACKOFF):
+        self.max_size = max_size
+        self.interval = interval
+        self.max_pending = max_pending
+        self.max_backoff = max_backoff
+        self._pending: "OrderedDict[Tuple[str, str], models.PointStruct]" = OrderedDict()
+        self._lock = asyncio.Lock()
+        self._flusher: Optional[asyncio.Task] = None
+        self._size_flush: Optional[asyncio.Task] = None
+        self._failures = 0
+        self._retry_at = 0.0
+        self._last_drop_log = 0.0
+        self.stats = {"flushed": 0, "failed_flushes": 0, "dropped": 0}
+
+    @property
+    def _size(self) -> int:
+        return len(self._pending)
+
+    def _trim(self):
+        dropped = 0
+        while len(self._pending) > self.max_pending:
+            self._pending.popitem(last=False)
+            dropped += 1
+        if dropped:
+            self.stats["dropped"] += dropped
+            FALLBACKS.labels(kind="write_buffer_drop").inc(dropped)
+            if time.monotonic() - self._last_drop_log >= 10:
+                self._last_drop_log = time.monotonic()
+                logger.warning(f"Write buffer full, dropping oldest learned points ({self.stats['dropped']} dropped so far)")
+
+    def add(self, task: str, text: str, embedding: List[float], payload: Optional[Dict] = None):
+        key = (task, point_id_for(task, text))
+        self._pending.pop(key, None)
+        self._pending[key] = models.PointStruct(id=key[1], vector=embedding, payload={**(payload or {}), "text": text})
+        self._trim()
+        # One size-triggered flush at a time, and none while backing off after a failure
+        if (self._size >= self.max_size and time.monotonic() >= self._retry_at
+                and (self._size_flush is None or self._size_flush.done())):
+            self._size_flush = asyncio.get_running_loop().create_task(self.flush())
+
+    async def flush(self, force: bool = False):
+        """Upsert everything buffered; skipped during backoff unless ``force``."""
+        if not force and time.monotonic() < self._retry_at:
+            return
+        async with self._lock:
+            pending, self._pending = self._pending, OrderedDict()
+            by_task: Dict[str, List[Tuple[Tuple[str, str], models.PointStruct]]] = {}
+            for key, point in pending.items():
+                by_task.setdefault(key[0], []).append((key, point))
+            failed: "OrderedDict[Tuple[str, str], models.PointStruct]" = OrderedDict()
+            for task, items in by_task.items():
+                try:
+                    with stage_timer("qdrant_upsert"):
+                        await client.upsert(collection_name=task, points=[point for _, point in items], wait=False)
+                    self.stats["flushed"] += len(items)
+                    logger.info(f"Flushed {len(items)} learned points to {task} collection")
+                except Exception as e:
+                    logger.error(f"Failed to flush {len(items)} points to {task}: {e}")
+                    failed.update(items)
+            if not failed:
+                self._failures, self._retry_at = 0, 0.0
+                return
+            self._failures += 1
+            self.stats["failed_flushes"] += 1
+            self._retry_at = time.monotonic() + min(self.max_backoff, self.interval * 2 ** (self._failures - 1))
+            # Requeue as the oldest points unless a newer version arrived meanwhile
+            for key in self._pending:
+                failed.pop(key, None)
+            failed.update(self._pending)
+            self._pending = failed
+            self._trim()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if self._size:
+                await self.flush()
+
+    def start(self):
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        await self.flush(force=True)
+
+vector_write_buffer = VectorWriteBuffer()
+
+def categories_key(categories: Optional[List[str]]) -> str:
+    # Order matters, as for the result cache: it shapes the prompt and the retrieval filter
+    return "|".join(categories) if categories else ""
+
+async def update_vector_db(task: str, prompt: str, result: Dict, embedding: Optional[List[float]] = None, categories: Optional[List[str]] = None):
+    """Queue a learned "prompt -> result" point; reuses the query embedding when given."""
+    try:
+        if embedding is None:
+            embedding = await embed_text(prompt)
+        # The structured fields let the semantic cache serve this result for near-duplicate prompts
+        payload = {"kind": "learned", "categories_key": categories_key(categories), "result": result, "model": CHAT_MODEL}
+        if task == "classify" and isinstance(result.get("category"), str):
+            payload["category"] = result["category"].lower()
+        text = f"{prompt} -> {json.dumps(result)}"
+        vector_write_buffer.add(task, text, embedding, payload)
+        if task in local_indexes:
+            local_indexes[task].add_hot(text, embedding)
     except Exception as e:
         logger.error(f"Failed to update vector DB for {task}: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to update vector DB: {str(e)}")
 
-async def retrieve_similar_docs(task: str, query: str, category: Optional[str] = None) -> List[str]:
-    try:
-        query_embedding = (await get_embeddings([query]))[0]
-        search_result = client.search(
+class SemanticCache:
+    """Serve stored results for near-duplicate prompts from the task's learned points.
+
+    A hit needs cosine similarity of at least ``threshold`` with a learned point
+    that has the same categories and was produced by the current chat model.
+    """
+
+    def __init__(self, enabled: bool = SEMANTIC_CACHE_ENABLED, threshold: float = SEMANTIC_CACHE_THRESHOLD):
+        self.enabled = enabled
+        self.threshold = threshold
+        self.stats = {"hits": 0, "misses": 0, "errors": 0}
+
+    async def lookup(self, task: str, query_embedding: List[float], categories: Optional[List[str]] = None) -> Optional[Dict]:
+        try:
+            hits = (await client.query_points(
+                collection_name=task,
+                query=query_embedding,
+                limit=1,
+                score_threshold=self.threshold,
+                search_params=search_params(),
+                query_filter=models.Filter(
+                    must=[
+                        models.FieldCondition(key="kind", match=models.MatchValue(value="learned")),
+                        models.FieldCondition(key="categories_key", match=models.MatchValue(value=categories_key(categories))),
+                        models.FieldCondition(key="model", match=models.MatchValue(value=CHAT_MODEL))
+                    ]
+                )
+            )).points
+        except Exception as e:
+            logger.warning(f"Semantic cache lookup failed for {task}: {e}")
+            self.stats["errors"] += 1
+            record_cache("semantic", "error")
+            return None
+        if not hits or not isinstance((hits[0].payload or {}).get("result"), dict):
+            self.stats["misses"] += 1
+            record_cache("semantic", "miss")
+            return None
+        self.stats["hits"] += 1
+        record_cache("semantic", "hit")
+        logger.info(f"Semantic cache hit for {task} (score {hits[0].score:.4f})")
+        return hits[0].payload["result"]
+
+    def get_stats(self) -> Dict:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "enabled": self.enabled,
+            "threshold": self.threshold,
+            "hit_ratio": self.stats["hits"] / lookups if lookups else 0.0,
+        }
+
+semantic_cache = SemanticCache()
+
+async def search_qdrant(task: str, query_embedding: List[float], category: Optional[str] = None, learned_only: bool = False) -> List:
+    must = []
+    if category and task == "classify":
+        must.append(models.Filter(should=[
+            models.FieldCondition(key="text", match=models.MatchText(text=category.lower())),
+            models.FieldCondition(key="category", match=models.MatchValue(value=category.lower()))
+        ]))
+    if learned_only:
+        must.append(models.FieldCondition(key="kind", match=models.MatchValue(value="learned")))
+    with stage_timer("qdrant_search"):
+        response = await client.query_points(
             collection_name=task,
-            query_vector=query_embedding,
+            query=query_embedding,
             limit=5,
-            query_filter=models.Filter(
-                must=[
-                    models.FieldCondition(
-                        key="text",
-                        match=models.MatchText(text=category.lower())
-                    )
-                ]
-            ) if category and task == "classify" else None
+            query_filter=models.Filter(must=must) if must else None,
+            search_params=search_params()
         )
-        logger.info(f"Retrieved {len(search_result)} documents for {task}")
-        return [hit.payload["text"] for hit in search_result]
+    return response.points
+
+async def retrieve_similar_docs(task: str, query: str, category: Optional[str] = None, query_embedding: Optional[List[float]] = None) -> List[str]:
+    try:
+        if query_embedding is None:
+            query_embedding = await embed_text(query)
+        index = local_indexes.get(task)
+        if index is None:
+            search_result = await search_qdrant(task, query_embedding, category)
+            logger.info(f"Retrieved {len(search_result)} documents for {task}")
+            return [hit.payload["text"] for hit in search_result]
+
+        # Seed corpus and this worker's hot set come from the local index; other
+        # workers' learned points only from Qdrant
+        with stage_timer("local_search"):
+            hits = index.search(query_embedding, limit=5, category=category if task == "classify" else None)
+        if LOCAL_INDEX_MERGE_QDRANT:
+            try:
+                learned = await search_qdrant(task, query_embedding, category, learned_only=True)
+                hits += [(hit.score, hit.payload["text"]) for hit in learned]
+            except Exception as e:
+                logger.warning(f"Learned-point search failed for {task}, using local hits only: {e}")
+        docs = list(dict.fromkeys(text for _, text in sorted(hits, key=lambda hit: hit[0], reverse=True)))[:5]
+        logger.info(f"Retrieved {len(docs)} documents for {task} (local index)")
+        return docs
     except Exception as e:
+        record_fallback("retrieval")
         logger.error(f"Failed to retrieve documents for {task}: {e}")
         return []
 
 async def rerank_results(task: str, results: List[str], query: str) -> List[str]:
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        headers = {"x-api-key": API_KEY}
-        if not results:
-            logger.warning(f"No documents to rerank for query: {query}")
-            return results
-        payload = {"model": "usf1-rerank", "input": {"query": query, "documents": results}}
-        logger.debug(f"Reranker payload: {payload}")
-        try:
-            response = await client.post(f"{BASE_URL_RERANK}/reranker", json=payload, headers=headers)
-            response.raise_for_status()
-            return response.json().get("ranked_documents", results)
-        except httpx.HTTPStatusError as e:
-            logger.error(f"Reranker API error: {e.response.status_code} - {e.response.text}")
-            return results
-        except Exception as e:
-            logger.error(f"Reranker processing error: {e}")
-            return results
+    key = flight_key("rerank", query, results)
+    return await singleflight.do(key, lambda: _rerank_results(task, results, query))
+
+async def _rerank_results(task: str, results: List[str], query: str) -> List[str]:
+    upstream = get_upstream("rerank")
+    headers = {"x-api-key": API_KEY}
+    if not results:
+        logger.warning(f"No documents to rerank for query: {query}")
+        return results
+    payload = {"model": "usf1-rerank", "input": {"query": query, "documents": results}}
+    logger.debug(f"Reranker payload: {payload}")
+    try:
+        with stage_timer("rerank"):
+            response = await upstream.post(f"{BASE_URL_RERANK}/reranker", json=payload, headers=headers)
+        response.raise_for_status()
+        record_upstream("rerank", "success")
+        return response.json().get("ranked_documents", results)
+    except httpx.HTTPStatusError as e:
+        record_upstream("rerank", "error")
+        record_fallback("rerank")
+        logger.error(f"Reranker API error: {e.response.status_code} - {e.response.text}")
+        return results
+    except Exception as e:
+        record_upstream("rerank", "error")
+        record_fallback("rerank")
+        logger.error(f"Reranker processing error: {e}")
+        return results
 
 async def check_qdrant_data():
     try:
-        collections = client.get_collections().collections
+        collections = (await client.get_collections()).collections
         logger.info(f"Collections: {[c.name for c in collections]}")
         for task in ["classify", "extract_entities", "summarize", "sentiment"]:
-            count = client.count(collection_name=task).count
+            count = (await client.count(collection_name=task)).count
             logger.info(f"{task} collection has {count} points")
     except Exception as e:
         logger.error(f"Failed to check Qdrant data: {e}")
@@ -0,0 +1,114 @@
+import asyncio
+import copy
+import hashlib
+import json
+import logging
+import os
+import uuid
+from typing import Any, Awaitable, Callable, Dict
+
+import redis.asyncio as redis
+from dotenv import load_dotenv
+
+load_dotenv()
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+SINGLEFLIGHT_REDIS = os.getenv("SINGLEFLIGHT_REDIS", "false").lower() == "true"
+SINGLEFLIGHT_LOCK_TTL = float(os.getenv("SINGLEFLIGHT_LOCK_TTL", 35.0))
+SINGLEFLIGHT_RESULT_TTL = float(os.getenv("SINGLEFLIGHT_RESULT_TTL", 10.0))
+SINGLEFLIGHT_POLL_INTERVAL = float(os.getenv("SINGLEFLIGHT_POLL_INTERVAL", 0.05))
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def flight_key(namespace: str, *parts: Any) -> str:
+    digest = hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+    return f"{namespace}:{digest}"
+
+class _LeaderCancelled(Exception):
+    """Set on a flight's future when its leader is cancelled, so followers retry."""
+
+class SingleFlight:
+    """Coalesce concurrent identical calls onto one upstream future.
+
+    Within a worker, callers with the same key await the leader's future. With
+    ``use_redis``, the leader also takes a Redis lock and publishes its result so
+    other workers poll for it instead of calling upstream; if the leader fails or
+    its lock expires, a follower falls back to calling upstream itself. A cancelled
+    leader doesn't cancel its followers: they retry and one becomes the new leader.
+    Every caller receives its own deep copy of the result.
+    """
+
+    def __init__(self, use_redis: bool = SINGLEFLIGHT_REDIS):
+        self.use_redis = use_redis
+        self._redis = None
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.stats = {"leaders": 0, "coalesced": 0, "remote_coalesced": 0}
+
+    def _get_redis(self):
+        if self._redis is None:
+            self._redis = redis.from_url(REDIS_URL)
+        return self._redis
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        while (future := self._inflight.get(key)) is not None:
+            self.stats["coalesced"] += 1
+            try:
+                return copy.deepcopy(await asyncio.shield(future))
+            except _LeaderCancelled:
+                # The leader's caller went away; retry, and the first follower back leads
+                continue
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        self.stats["leaders"] += 1
+        try:
+            result = await (self._do_shared(key, fn) if self.use_redis else fn())
+            future.set_result(result)
+            return copy.deepcopy(result)
+        except asyncio.CancelledError:
+            # Don't pass our own cancellation on to followers
+            future.set_exception(_LeaderCancelled())
+            future.exception()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Mark the exception retrieved when nobody else was waiting
+            future.exception()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+    async def _do_shared(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        try:
+            client = self._get_redis()
+            token = uuid.uuid4().hex
+            lock_key, result_key = f"sf:lock:{key}", f"sf:result:{key}"
+            acquired = await client.set(lock_key, token, nx=True, px=int(SINGLEFLIGHT_LOCK_TTL * 1000))
+        except Exception as e:
+            logger.warning(f"Single-flight Redis unavailable, calling upstream directly: {e}")
+            return await fn()
+
+        if not acquired:
+            while await client.exists(lock_key):
+                raw = await client.get(result_key)
+                if raw is not None:
+                    self.stats["remote_coalesced"] += 1
+                    return json.loads(raw)
+                await asyncio.sleep(SINGLEFLIGHT_POLL_INTERVAL)
+            raw = await client.get(result_key)
+            if raw is not None:
+                self.stats["remote_coalesced"] += 1
+                return json.loads(raw)
+            return await fn()
+
+        try:
+            result = await fn()
+            await client.set(result_key, json.dumps(result), px=int(SINGLEFLIGHT_RESULT_TTL * 1000))
+            return result
+        finally:
+            # Only release our own lock
+            if await client.get(lock_key) == token.encode():
+                await client.delete(lock_key)
+
+singleflight = SingleFlight()
@@ -0,0 +1,359 @@
+import asyncio
+import logging
+import os
+import random
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import AsyncIterator, Dict, Optional, Tuple
+
+import httpx
+from dotenv import load_dotenv
+
+from .clients import get_client
+from .metrics import UPSTREAM_LIMIT, record_upstream
+
+load_dotenv()
+UPSTREAM_RETRIES = int(os.getenv("UPSTREAM_RETRIES", 2))
+UPSTREAM_BACKOFF_BASE = float(os.getenv("UPSTREAM_BACKOFF_BASE", 0.2))
+UPSTREAM_BACKOFF_MAX = float(os.getenv("UPSTREAM_BACKOFF_MAX", 5.0))
+UPSTREAM_RETRY_AFTER_MAX = float(os.getenv("UPSTREAM_RETRY_AFTER_MAX", 30.0))
+UPSTREAM_INITIAL_LIMIT = int(os.getenv("UPSTREAM_INITIAL_LIMIT", 16))
+UPSTREAM_MIN_LIMIT = int(os.getenv("UPSTREAM_MIN_LIMIT", 1))
+UPSTREAM_MAX_LIMIT = int(os.getenv("UPSTREAM_MAX_LIMIT", 64))
+UPSTREAM_LATENCY_TOLERANCE = float(os.getenv("UPSTREAM_LATENCY_TOLERANCE", 2.0))
+UPSTREAM_BREAKER_THRESHOLD = int(os.getenv("UPSTREAM_BREAKER_THRESHOLD", 5))
+UPSTREAM_BREAKER_COOLDOWN = float(os.getenv("UPSTREAM_BREAKER_COOLDOWN", 30.0))
+# Comma-separated upstreams that may send a second copy of a slow request, e.g. "embed,rerank"
+UPSTREAM_HEDGE = [name.strip() for name in os.getenv("UPSTREAM_HEDGE", "").split(",") if name.strip()]
+UPSTREAM_HEDGE_PERCENTILE = float(os.getenv("UPSTREAM_HEDGE_PERCENTILE", 95))
+UPSTREAM_HEDGE_MIN_SAMPLES = int(os.getenv("UPSTREAM_HEDGE_MIN_SAMPLES", 20))
+
+# Responses that mean "try again later" rather than "this request is wrong"
+RETRY_STATUSES = {429, 502, 503, 504}
+OVERLOAD_STATUSES = {429, 503}
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def _setting(name: str, key: str, default, cast=float):
+    return cast(os.getenv(f"UPSTREAM_{name.upper()}_{key}", default))
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream whose circuit breaker is open."""
+
+class AdaptiveLimiter:
+    """AIMD concurrency limit for one upstream.
+
+    Each success below ``tolerance`` times the baseline latency raises the limit by
+    1/limit (about one slot per round of calls). A 429/503 or timeout halves it, and a
+    sustained latency rise while all slots are busy cuts it by 10%; either cut happens
+    at most once per baseline latency.
+    """
+
+    def __init__(self, name: str, initial: int, minimum: int, maximum: int, tolerance: float):
+        self.name = name
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.tolerance = tolerance
+        self.in_flight = 0
+        self._waiters: "deque[asyncio.Future]" = deque()
+        self._baseline: Optional[float] = None
+        self._recent: Optional[float] = None
+        self._last_decrease = 0.0
+        UPSTREAM_LIMIT.labels(upstream=name).set(self.limit)
+
+    def has_capacity(self) -> bool:
+        return self.in_flight < int(self.limit)
+
+    async def acquire(self):
+        while self.in_flight >= int(self.limit):
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                elif waiter.done() and not waiter.cancelled():
+                    # Woken but cancelled before taking the slot: pass it on
+                    self._wake()
+                raise
+        self.in_flight += 1
+
+    def release(self):
+        self.in_flight -= 1
+        self._wake()
+
+    def _wake(self):
+        free = int(self.limit) - self.in_flight
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    def on_sample(self, latency: float, overloaded: bool = False):
+        if overloaded:
+            self._decrease(0.5)
+            return
+        if self._baseline is None or latency < self._baseline:
+            self._baseline = latency
+        else:
+            # Let the baseline drift up slowly so a lasting change in payloads is accepted
+            self._baseline += 0.01 * (latency - self._baseline)
+        self._recent = latency if self._recent is None else self._recent + 0.1 * (latency - self._recent)
+        # Only blame our own concurrency for slowness when every slot is in use;
+        # otherwise the upstream (or this event loop) is slow for other reasons
+        saturated = bool(self._waiters) or self.in_flight >= int(self.limit)
+        if saturated and self._recent > self.tolerance * self._baseline:
+            self._decrease(0.9)
+        else:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            UPSTREAM_LIMIT.labels(upstream=self.name).set(self.limit)
+            self._wake()
+
+    def _decrease(self, factor: float):
+        now = time.monotonic()
+        if now - self._last_decrease < (self._baseline or 0.0):
+            return
+        self._last_decrease = now
+        self.limit = max(self.minimum, self.limit * factor)
+        UPSTREAM_LIMIT.labels(upstream=self.name).set(self.limit)
+        logger.info(f"Concurrency limit for {self.name} lowered to {int(self.limit)}")
+
+class CircuitBreaker:
+    """Open after ``threshold`` consecutive failures; after ``cooldown`` let one probe through."""
+
+    def __init__(self, name: str, threshold: int, cooldown: float):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self.opened_at >= self.cooldown else "open"
+
+    def before_call(self):
+        state = self.state
+        if state == "open" or (state == "half_open" and self._probing):
+            record_upstream(self.name, "circuit_open")
+            raise CircuitOpenError(f"{self.name} upstream is unavailable (circuit open)")
+        if state == "half_open":
+            self._probing = True
+
+    def cancel_probe(self):
+        self._probing = False
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info(f"Circuit for {self.name} closed")
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self._probing or (self.opened_at is None and self.failures >= self.threshold):
+            logger.warning(f"Circuit for {self.name} opened after {self.failures} consecutive failures")
+            self.opened_at = time.monotonic()
+        self._probing = False
+
+def retry_after(response: httpx.Response) -> Optional[float]:
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def is_throttled(response: httpx.Response) -> bool:
+    return response.status_code == 429 or (response.status_code == 503 and "Retry-After" in response.headers)
+
+class Upstream:
+    """Managed calls to one upstream: adaptive concurrency, retries, circuit breaker and hedging.
+
+    Retries use full-jitter exponential backoff on transport errors and 429/502/503/504,
+    waiting at least as long as the response's Retry-After. When hedging is enabled, a
+    request still running after the upstream's recent p95 latency is sent once more if
+    the limiter has a free slot, and whichever answers first wins.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.retries = _setting(name, "RETRIES", UPSTREAM_RETRIES, int)
+        self.limiter = AdaptiveLimiter(
+            name,
+            initial=_setting(name, "INITIAL_LIMIT", UPSTREAM_INITIAL_LIMIT, int),
+            minimum=_setting(name, "MIN_LIMIT", UPSTREAM_MIN_LIMIT, int),
+            maximum=_setting(name, "MAX_LIMIT", UPSTREAM_MAX_LIMIT, int),
+            tolerance=_setting(name, "LATENCY_TOLERANCE", UPSTREAM_LATENCY_TOLERANCE),
+        )
+        self.breaker = CircuitBreaker(
+            name,
+            threshold=_setting(name, "BREAKER_THRESHOLD", UPSTREAM_BREAKER_THRESHOLD, int),
+            cooldown=_setting(name, "BREAKER_COOLDOWN", UPSTREAM_BREAKER_COOLDOWN),
+        )
+        self.hedge = name in UPSTREAM_HEDGE
+        self._latencies: "deque[float]" = deque(maxlen=200)
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(UPSTREAM_BACKOFF_MAX, UPSTREAM_BACKOFF_BASE * 2 ** attempt))
+
+    def hedge_delay(self) -> Optional[float]:
+        if not self.hedge or len(self._latencies) < UPSTREAM_HEDGE_MIN_SAMPLES:
+            return None
+        latencies = sorted(self._latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * UPSTREAM_HEDGE_PERCENTILE / 100))]
+
+    def _record(self, start: float, response: Optional[httpx.Response] = None, error: Optional[Exception] = None, hedge_sample: bool = True):
+        latency = time.monotonic() - start
+        if error is not None:
+            self.limiter.on_sample(latency, overloaded=isinstance(error, httpx.TimeoutException))
+            self.breaker.record_failure()
+        elif response.status_code in RETRY_STATUSES or response.status_code >= 500:
+            self.limiter.on_sample(latency, overloaded=response.status_code in OVERLOAD_STATUSES)
+            # Throttling is handled by the limiter and Retry-After; only outages trip the breaker
+            if is_throttled(response):
+                self.breaker.cancel_probe()
+            else:
+                self.breaker.record_failure()
+        else:
+            self.limiter.on_sample(latency)
+            self.breaker.record_success()
+            if hedge_sample:
+                self._latencies.append(latency)
+
+    async def _attempt(self, method: str, url: str, kwargs: Dict) -> httpx.Response:
+        await self.limiter.acquire()
+        start = time.monotonic()
+        try:
+            response = await get_client(self.name).request(method, url, **kwargs)
+        except asyncio.CancelledError:
+            self.breaker.cancel_probe()
+            raise
+        except Exception as e:
+            self._record(start, error=e)
+            raise
+        else:
+            self._record(start, response=response)
+            return response
+        finally:
+            self.limiter.release()
+
+    async def _hedged_attempt(self, method: str, url: str, kwargs: Dict) -> httpx.Response:
+        delay = self.hedge_delay()
+        if delay is None:
+            return await self._attempt(method, url, kwargs)
+        first = asyncio.ensure_future(self._attempt(method, url, kwargs))
+        pending = {first}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=delay)
+            if done or not self.limiter.has_capacity():
+                return await first
+            record_upstream(self.name, "hedge")
+            pending.add(asyncio.ensure_future(self._attempt(method, url, kwargs)))
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None and task.result().status_code not in RETRY_STATUSES:
+                        return task.result()
+            return first.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """Send a request and return the final response; raise the last transport error."""
+        for attempt in range(self.retries + 1):
+            self.breaker.before_call()
+            try:
+                response = await self._hedged_attempt(method, url, kwargs)
+            except httpx.TransportError as e:
+                if attempt == self.retries:
+                    raise
+                delay = self.backoff(attempt)
+                logger.warning(f"{self.name} request failed ({e!r}), retrying in {delay:.2f}s")
+            else:
+                if response.status_code not in RETRY_STATUSES or attempt == self.retries:
+                    return response
+                wait = retry_after(response)
+                if wait is not None and wait > UPSTREAM_RETRY_AFTER_MAX:
+                    return response
+                delay = max(self.backoff(attempt), wait or 0.0)
+                logger.warning(f"{self.name} returned {response.status_code}, retrying in {delay:.2f}s")
+            record_upstream(self.name, "retry")
+            await asyncio.sleep(delay)
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("POST", url, **kwargs)
+
+    @asynccontextmanager
+    async def stream(self, method: str, url: str, **kwargs) -> AsyncIterator[httpx.Response]:
+        """Like ``httpx.AsyncClient.stream``; retries only happen before the body is read."""
+        await self.limiter.acquire()
+        try:
+            for attempt in range(self.retries + 1):
+                self.breaker.before_call()
+                start = time.monotonic()
+                context = get_client(self.name).stream(method, url, **kwargs)
+                try:
+                    response = await context.__aenter__()
+                except httpx.TransportError as e:
+                    self._record(start, error=e)
+                    if attempt == self.retries:
+                        raise
+                    delay = self.backoff(attempt)
+                else:
+                    # Time to headers only, so it stays out of the hedging window
+                    self._record(start, response=response, hedge_sample=False)
+                    wait = retry_after(response)
+                    if response.status_code not in RETRY_STATUSES or attempt == self.retries or (wait or 0.0) > UPSTREAM_RETRY_AFTER_MAX:
+                        break
+                    await context.__aexit__(None, None, None)
+                    delay = max(self.backoff(attempt), wait or 0.0)
+                record_upstream(self.name, "retry")
+                await asyncio.sleep(delay)
+            try:
+                yield response
+            finally:
+                await context.__aexit__(None, None, None)
+        finally:
+            self.limiter.release()
+
+    def get_stats(self) -> Dict:
+        return {
+            "limit": int(self.limiter.limit),
+            "in_flight": self.limiter.in_flight,
+            "circuit": self.breaker.state,
+            "hedge_delay": self.hedge_delay(),
+        }
+
+_upstreams: Dict[str, Tuple[asyncio.AbstractEventLoop, Upstream]] = {}
+
+def get_upstream(name: str) -> Upstream:
+    """Return the managed upstream for ``name`` in the running loop (see ``get_client``)."""
+    loop = asyncio.get_running_loop()
+    entry = _upstreams.get(name)
+    if entry is not None and entry[0] is loop:
+        return entry[1]
+    upstream = Upstream(name)
+    _upstreams[name] = (loop, upstream)
+    return upstream
+
+def upstream_stats() -> Dict:
+    return {name: upstream.get_stats() for name, (_, upstream) in _upstreams.items()}
@@ -1,7 +1,11 @@
 import httpx
 import os
+import re
+from typing import List
 from dotenv import load_dotenv
 import logging
+from .clients import get_client
+from .metrics import stage_timer, record_upstream
 
 load_dotenv()
 API_KEY = os.getenv("API_KEY")
@@ -11,13 +15,54 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 async def notify_webhook(webhook_url: str, data: dict):
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        headers = {"x-api-key": API_KEY, "Content-Type": "application/json"}
-        try:
+    client = get_client("webhook")
+    headers = {"x-api-key": API_KEY, "Content-Type": "application/json"}
+    try:
+        with stage_timer("webhook"):
             response = await client.post(webhook_url, json=data, headers=headers)
-            response.raise_for_status()
-            logger.info(f"Webhook notified successfully: {webhook_url}")
-        except httpx.HTTPStatusError as e:
-            logger.error(f"Webhook notification failed: {e.response.status_code} - {e.response.text}")
-        except Exception as e:
-            logger.error(f"Webhook notification error: {e}")
\ No newline at end of file
+        response.raise_for_status()
+        record_upstream("webhook", "success")
+        logger.info(f"Webhook notified successfully: {webhook_url}")
+    except httpx.HTTPStatusError as e:
+        record_upstream("webhook", "error")
+        logger.error(f"Webhook notification failed: {e.response.status_code} - {e.response.text}")
+    except Exception as e:
+        record_upstream("webhook", "error")
+        logger.error(f"Webhook notification error: {e}")
+
+def split_text(text: str, max_chars: int, overlap: int = 0) -> List[str]:
+    """Split text into chunks of at most ``max_chars`` on paragraph and sentence boundaries.
+
+    Each chunk after the first starts with up to ``overlap`` characters of trailing
+    sentences from the previous chunk. A single sentence longer than ``max_chars``
+    is hard-split.
+    """
+    if max_chars < 1:
+        raise ValueError(f"max_chars must be at least 1, got {max_chars}")
+    text = text.strip()
+    if len(text) <= max_chars:
+        return [text] if text else []
+    sentences = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        for sentence in re.split(r"(?<=[.!?])\s+", paragraph.strip()):
+            while len(sentence) > max_chars:
+                sentences.append(sentence[:max_chars])
+                sentence = sentence[max_chars:]
+            if sentence:
+                sentences.append(sentence)
+
+    chunks, current = [], []
+    for sentence in sentences:
+        if current and len(" ".join(current + [sentence])) > max_chars:
+            chunks.append(" ".join(current))
+            # Carry trailing sentences into the next chunk as overlap
+            carried = []
+            for previous in reversed(current):
+                if len(" ".join([previous] + carried + [sentence])) > min(overlap + len(sentence) + 1, max_chars):
+                    break
+                carried.insert(0, previous)
+            current = carried
+        current.append(sentence)
+    if current:
+        chunks.append(" ".join(current))
+    return chunks
@@ -0,0 +1,328 @@
+"""Durable webhook delivery.
+
+The API and Celery workers only push jobs onto a Redis list; a separate dispatcher
+process delivers them, so slow or failing receivers never hold up request handling:
+
+    python -m app.webhooks                 # run a dispatcher
+    python -m app.webhooks --stats         # queue, retry and dead-letter sizes
+    python -m app.webhooks --requeue-dead  # retry everything in the dead-letter list
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import signal
+import socket
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import httpx
+import redis.asyncio as redis
+from dotenv import load_dotenv
+
+from .clients import HTTP2_ENABLED, HTTP_CONNECT_TIMEOUT, HTTP_KEEPALIVE_EXPIRY
+from .metrics import record_upstream, stage_timer
+from .upstream import retry_after
+from .utils import notify_webhook
+
+load_dotenv()
+API_KEY = os.getenv("API_KEY")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+WEBHOOK_QUEUE_ENABLED = os.getenv("WEBHOOK_QUEUE_ENABLED", "false").lower() == "true"
+WEBHOOK_DISPATCHER_ID = os.getenv("WEBHOOK_DISPATCHER_ID", socket.gethostname())
+WEBHOOK_CONCURRENCY = int(os.getenv("WEBHOOK_CONCURRENCY", 32))
+WEBHOOK_HOST_CONCURRENCY = int(os.getenv("WEBHOOK_HOST_CONCURRENCY", 4))
+WEBHOOK_TIMEOUT = float(os.getenv("WEBHOOK_TIMEOUT", 10.0))
+# More than 1 sends a JSON array of up to this many results per POST to the same URL
+WEBHOOK_BATCH_MAX = int(os.getenv("WEBHOOK_BATCH_MAX", 1))
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", 8))
+WEBHOOK_BACKOFF_BASE = float(os.getenv("WEBHOOK_BACKOFF_BASE", 1.0))
+WEBHOOK_BACKOFF_MAX = float(os.getenv("WEBHOOK_BACKOFF_MAX", 600.0))
+WEBHOOK_DEAD_LETTER_MAX = int(os.getenv("WEBHOOK_DEAD_LETTER_MAX", 10000))
+WEBHOOK_RETRY_POLL = float(os.getenv("WEBHOOK_RETRY_POLL", 1.0))
+# A dispatcher that hasn't renewed its lease for this long is presumed dead and its jobs are requeued
+WEBHOOK_LEASE_TTL = int(os.getenv("WEBHOOK_LEASE_TTL", 30))
+WEBHOOK_METRICS_PORT = int(os.getenv("WEBHOOK_METRICS_PORT", 0))
+
+WEBHOOK_QUEUE_KEY = "nlp:webhooks:queue"
+WEBHOOK_RETRY_KEY = "nlp:webhooks:retry"
+WEBHOOK_DEAD_KEY = "nlp:webhooks:dead"
+WEBHOOK_PROCESSING_PREFIX = "nlp:webhooks:processing:"
+WEBHOOK_LEASE_PREFIX = "nlp:webhooks:lease:"
+
+# Move due retries back onto the queue in one step, so two dispatchers never both take one
+PROMOTE_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, job in ipairs(due) do
+    redis.call('ZREM', KEYS[1], job)
+    redis.call('RPUSH', KEYS[2], job)
+end
+return #due
+"""
+
+# Requeue a dispatcher's in-flight jobs, unless it still holds its lease
+RECOVER_SCRIPT = """
+if KEYS[1] ~= '' and redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+local moved = 0
+while redis.call('LMOVE', KEYS[2], KEYS[3], 'RIGHT', 'LEFT') do
+    moved = moved + 1
+end
+return moved
+"""
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+_redis = None
+
+def _get_redis():
+    global _redis
+    if _redis is None:
+        _redis = redis.from_url(REDIS_URL)
+    return _redis
+
+async def enqueue_webhook(url: str, payload: Dict):
+    """Queue a result for delivery, or deliver it now if the queue is off or Redis is down."""
+    if not WEBHOOK_QUEUE_ENABLED:
+        await notify_webhook(url, payload)
+        return
+    job = {"id": str(uuid.uuid4()), "url": url, "payload": payload, "attempts": 0, "enqueued_at": time.time()}
+    try:
+        await _get_redis().rpush(WEBHOOK_QUEUE_KEY, json.dumps(job, separators=(",", ":")))
+    except Exception as e:
+        logger.warning(f"Failed to queue webhook for {url}, delivering directly: {e}")
+        await notify_webhook(url, payload)
+
+class WebhookDispatcher:
+    """Deliver queued webhooks with per-host pools, optional batching, retries and a dead-letter list.
+
+    Jobs are moved from the queue to this dispatcher's processing list while being
+    delivered. Each dispatcher renews a lease key while it runs. At startup it puts its
+    own leftover jobs back on the queue, and it periodically does the same for other
+    dispatchers whose lease has expired, so delivery is at-least-once even if a
+    dispatcher never comes back. Failed jobs wait in a sorted set until their backoff
+    (or the receiver's Retry-After) has passed; after ``WEBHOOK_MAX_ATTEMPTS`` tries, or
+    on a 4xx other than 408/429, they go to the dead-letter list.
+    """
+
+    def __init__(self, redis_client, consumer: str = WEBHOOK_DISPATCHER_ID):
+        self.redis = redis_client
+        self.consumer = consumer
+        self.processing_key = f"{WEBHOOK_PROCESSING_PREFIX}{consumer}"
+        self.lease_key = f"{WEBHOOK_LEASE_PREFIX}{consumer}"
+        self._promote = self.redis.register_script(PROMOTE_SCRIPT)
+        self._recover = self.redis.register_script(RECOVER_SCRIPT)
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        self._host_slots: Dict[str, asyncio.Semaphore] = {}
+        self._slots = asyncio.Semaphore(WEBHOOK_CONCURRENCY)
+        self._tasks = set()
+        self.stats = {"delivered": 0, "posts": 0, "retried": 0, "dead": 0}
+
+    def _host(self, url: str) -> Tuple[httpx.AsyncClient, asyncio.Semaphore]:
+        host = urlsplit(url).netloc
+        if host not in self._clients:
+            self._clients[host] = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=WEBHOOK_HOST_CONCURRENCY, max_keepalive_connections=WEBHOOK_HOST_CONCURRENCY, keepalive_expiry=HTTP_KEEPALIVE_EXPIRY),
+                timeout=httpx.Timeout(WEBHOOK_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+                http2=HTTP2_ENABLED
+            )
+            self._host_slots[host] = asyncio.Semaphore(WEBHOOK_HOST_CONCURRENCY)
+        return self._clients[host], self._host_slots[host]
+
+    async def renew_lease(self):
+        await self.redis.set(self.lease_key, self.consumer, ex=WEBHOOK_LEASE_TTL)
+
+    async def recover(self):
+        """Requeue jobs this dispatcher left behind when it last stopped. Only safe before delivering."""
+        moved = await self._recover(keys=["", self.processing_key, WEBHOOK_QUEUE_KEY])
+        if moved:
+            logger.info(f"Requeued {moved} webhooks left in {self.processing_key}")
+
+    async def sweep_stale(self):
+        """Requeue the in-flight jobs of other dispatchers whose lease has expired."""
+        async for key in self.redis.scan_iter(match=f"{WEBHOOK_PROCESSING_PREFIX}*"):
+            key = key.decode() if isinstance(key, bytes) else key
+            if key == self.processing_key:
+                continue
+            lease_key = f"{WEBHOOK_LEASE_PREFIX}{key[len(WEBHOOK_PROCESSING_PREFIX):]}"
+            moved = await self._recover(keys=[lease_key, key, WEBHOOK_QUEUE_KEY])
+            if moved:
+                logger.warning(f"Requeued {moved} webhooks from {key}, whose dispatcher stopped renewing its lease")
+
+    async def _pop(self) -> List[bytes]:
+        first = await self.redis.blmove(WEBHOOK_QUEUE_KEY, self.processing_key, 1, "LEFT", "RIGHT")
+        if first is None:
+            return []
+        raws = [first]
+        while len(raws) < WEBHOOK_BATCH_MAX:
+            raw = await self.redis.lmove(WEBHOOK_QUEUE_KEY, self.processing_key, "LEFT", "RIGHT")
+            if raw is None:
+                break
+            raws.append(raw)
+        return raws
+
+    async def _promote_loop(self, stop: asyncio.Event):
+        last_sweep = time.monotonic()
+        while not stop.is_set():
+            try:
+                await self._promote(keys=[WEBHOOK_RETRY_KEY, WEBHOOK_QUEUE_KEY], args=[time.time(), 500])
+            except Exception as e:
+                logger.error(f"Failed to promote webhook retries: {e}")
+            try:
+                await self.renew_lease()
+                if time.monotonic() - last_sweep >= WEBHOOK_LEASE_TTL:
+                    last_sweep = time.monotonic()
+                    await self.sweep_stale()
+            except Exception as e:
+                logger.error(f"Failed to renew webhook lease or recover stale jobs: {e}")
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=WEBHOOK_RETRY_POLL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _deliver(self, url: str, jobs: List[Tuple[bytes, Dict]]):
+        client, host_slots = self._host(url)
+        # Receivers of a batching dispatcher always get an array, even of one result
+        body = [job["payload"] for _, job in jobs] if WEBHOOK_BATCH_MAX > 1 else jobs[0][1]["payload"]
+        error, wait, permanent = None, None, False
+        async with host_slots:
+            try:
+                with stage_timer("webhook"):
+                    response = await client.post(url, json=body, headers={"x-api-key": API_KEY, "Content-Type": "application/json"})
+                if response.is_error:
+                    error = f"HTTP {response.status_code}"
+                    wait = retry_after(response)
+                    permanent = response.status_code < 500 and response.status_code not in (408, 429)
+            except Exception as e:
+                error = repr(e)
+        self.stats["posts"] += 1
+        record_upstream("webhook", "error" if error else "success")
+        if error is None:
+            async with self.redis.pipeline(transaction=True) as pipe:
+                for raw, _ in jobs:
+                    pipe.lrem(self.processing_key, 1, raw)
+                await pipe.execute()
+            self.stats["delivered"] += len(jobs)
+            return
+        logger.warning(f"Webhook delivery of {len(jobs)} results to {url} failed: {error}")
+        for raw, job in jobs:
+            await self._fail(raw, job, error, wait, permanent)
+
+    async def _fail(self, raw: bytes, job: Dict, error: str, wait: Optional[float], permanent: bool):
+        job = {**job, "attempts": job["attempts"] + 1, "last_error": error}
+        async with self.redis.pipeline(transaction=True) as pipe:
+            if permanent or job["attempts"] >= WEBHOOK_MAX_ATTEMPTS:
+                job["failed_at"] = datetime.now().isoformat()
+                pipe.lpush(WEBHOOK_DEAD_KEY, json.dumps(job, separators=(",", ":")))
+                pipe.ltrim(WEBHOOK_DEAD_KEY, 0, WEBHOOK_DEAD_LETTER_MAX - 1)
+                self.stats["dead"] += 1
+                record_upstream("webhook", "dead_letter")
+                logger.error(f"Webhook {job['id']} to {job['url']} moved to dead-letter list after {job['attempts']} attempts: {error}")
+            else:
+                delay = max(random.uniform(0, min(WEBHOOK_BACKOFF_MAX, WEBHOOK_BACKOFF_BASE * 2 ** job["attempts"])), wait or 0.0)
+                pipe.zadd(WEBHOOK_RETRY_KEY, {json.dumps(job, separators=(",", ":")): time.time() + delay})
+                self.stats["retried"] += 1
+            pipe.lrem(self.processing_key, 1, raw)
+            await pipe.execute()
+
+    async def _deliver_all(self, raws: List[bytes]):
+        by_url: Dict[str, List[Tuple[bytes, Dict]]] = defaultdict(list)
+        for raw in raws:
+            try:
+                job = json.loads(raw)
+            except json.JSONDecodeError:
+                logger.error(f"Dropping malformed webhook job: {raw[:200]!r}")
+                await self.redis.lrem(self.processing_key, 1, raw)
+                continue
+            by_url[job["url"]].append((raw, job))
+        await asyncio.gather(*(self._deliver(url, jobs) for url, jobs in by_url.items()))
+
+    async def run(self, stop: asyncio.Event):
+        await self.renew_lease()
+        await self.recover()
+        await self.sweep_stale()
+        promoter = asyncio.create_task(self._promote_loop(stop))
+        logger.info(f"Webhook dispatcher started (concurrency={WEBHOOK_CONCURRENCY}, batch={WEBHOOK_BATCH_MAX})")
+        try:
+            while not stop.is_set():
+                # Only take jobs off the queue when there is capacity to send them
+                await self._slots.acquire()
+                try:
+                    raws = await self._pop()
+                except Exception as e:
+                    self._slots.release()
+                    logger.error(f"Failed to read webhook queue: {e}")
+                    await asyncio.sleep(1)
+                    continue
+                if not raws:
+                    self._slots.release()
+                    continue
+                task = asyncio.create_task(self._deliver_all(raws))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+                task.add_done_callback(lambda _: self._slots.release())
+        finally:
+            if self._tasks:
+                await asyncio.gather(*self._tasks, return_exceptions=True)
+            await promoter
+            for client in self._clients.values():
+                await client.aclose()
+            try:
+                await self.redis.delete(self.lease_key)
+            except Exception:
+                pass
+            logger.info(f"Webhook dispatcher stopped: {self.stats}")
+
+async def queue_stats(redis_client) -> Dict:
+    return {
+        "queued": await redis_client.llen(WEBHOOK_QUEUE_KEY),
+        "retrying": await redis_client.zcard(WEBHOOK_RETRY_KEY),
+        "dead": await redis_client.llen(WEBHOOK_DEAD_KEY),
+    }
+
+async def requeue_dead(redis_client) -> int:
+    moved = 0
+    while (raw := await redis_client.rpop(WEBHOOK_DEAD_KEY)) is not None:
+        job = json.loads(raw)
+        job["attempts"] = 0
+        await redis_client.rpush(WEBHOOK_QUEUE_KEY, json.dumps(job, separators=(",", ":")))
+        moved += 1
+    return moved
+
+async def main_async(args):
+    redis_client = redis.from_url(REDIS_URL)
+    try:
+        if args.stats:
+            print(json.dumps(await queue_stats(redis_client)))
+            return
+        if args.requeue_dead:
+            print(f"Requeued {await requeue_dead(redis_client)} dead-lettered webhooks")
+            return
+        if WEBHOOK_METRICS_PORT:
+            from prometheus_client import start_http_server
+            start_http_server(WEBHOOK_METRICS_PORT)
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        await WebhookDispatcher(redis_client).run(stop)
+    finally:
+        await redis_client.aclose()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--stats", action="store_true", help="print queue sizes and exit")
+    parser.add_argument("--requeue-dead", action="store_true", help="move dead-lettered webhooks back onto the queue and exit")
+    asyncio.run(main_async(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
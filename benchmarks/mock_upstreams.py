@@ -0,0 +1,134 @@
+"""Local stand-ins for the chat, embedding, reranker and webhook upstreams.
+
+Each endpoint sleeps for a configurable latency and counts its calls, so benchmark
+runs are offline, deterministic and free. Run with:
+
+    python benchmarks/mock_upstreams.py --port 9100 --chat-latency 300 --embed-latency 40
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import re
+from collections import Counter
+
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+app = FastAPI(title="Mock upstreams")
+latency = {"chat": 0.3, "embed": 0.04, "rerank": 0.05, "webhook": 0.01}
+calls = Counter()
+# Share of chat/embed/rerank calls answered with 429, to exercise retries and backoff
+settings = {"error_rate": 0.0}
+
+def throttled(name: str):
+    if random.random() < settings["error_rate"]:
+        calls[f"{name}_429"] += 1
+        return JSONResponse({"detail": "rate limited"}, status_code=429, headers={"Retry-After": "0"})
+    return None
+
+TASK_RESULTS = {
+    "classify": {"category": "infectious", "confidence": 0.9},
+    "extract_entities": {"entities": ["fever", "cough"]},
+    "summarize": {"summary": "Mock summary."},
+    "sentiment": {"sentiment": "neutral", "score": 0.5},
+}
+
+def detect_task(prompt: str) -> str:
+    if prompt.startswith("Classify") or "classify it" in prompt:
+        return "classify"
+    if prompt.startswith("Extract entities") or "extract its entities" in prompt:
+        return "extract_entities"
+    if prompt.startswith("Determine the sentiment") or "determine its sentiment" in prompt:
+        return "sentiment"
+    return "summarize"
+
+def mock_completion(prompt: str) -> str:
+    """Answer in the shape the app's prompt asks for: packed array, multi-task object or single object."""
+    if "Return only a JSON array" in prompt:
+        count = len(re.findall(r"^\d+\. '", prompt, flags=re.MULTILINE))
+        result = TASK_RESULTS[detect_task(prompt)]
+        return json.dumps([{"index": i, **result} for i in range(count)])
+    if "Return only one JSON object with these keys" in prompt:
+        tasks = re.findall(r"^- '(\w+)':", prompt, flags=re.MULTILINE)
+        return json.dumps({task: TASK_RESULTS[task] for task in tasks})
+    return json.dumps(TASK_RESULTS[detect_task(prompt)])
+
+def mock_embedding(text: str) -> list:
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    return np.random.default_rng(seed).standard_normal(1024).astype(np.float32).tolist()
+
+@app.post("/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    calls["chat"] += 1
+    if (response := throttled("chat")) is not None:
+        return response
+    content = mock_completion(body["messages"][0]["content"])
+    if not body.get("stream"):
+        await asyncio.sleep(latency["chat"])
+        return {"choices": [{"message": {"content": content}}]}
+
+    async def events():
+        pieces = [content[i:i + 8] for i in range(0, len(content), 8)]
+        for piece in pieces:
+            await asyncio.sleep(latency["chat"] / len(pieces))
+            yield f"data: {json.dumps({'choices': [{'delta': {'content': piece}}]})}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+@app.post("/embeddings")
+async def embeddings(request: Request):
+    body = await request.json()
+    calls["embed"] += 1
+    if (response := throttled("embed")) is not None:
+        return response
+    calls["embed_items"] += len(body["input"])
+    await asyncio.sleep(latency["embed"])
+    return {"result": {"data": [{"embedding": mock_embedding(text)} for text in body["input"]]}}
+
+@app.post("/reranker")
+async def reranker(request: Request):
+    body = await request.json()
+    calls["rerank"] += 1
+    if (response := throttled("rerank")) is not None:
+        return response
+    await asyncio.sleep(latency["rerank"])
+    return {"ranked_documents": body["input"]["documents"]}
+
+@app.post("/webhook")
+async def webhook(request: Request):
+    body = await request.json()
+    calls["webhook"] += 1
+    calls["webhook_items"] += len(body) if isinstance(body, list) else 1
+    await asyncio.sleep(latency["webhook"])
+    return {"ok": True}
+
+@app.get("/stats")
+async def stats():
+    return dict(calls)
+
+@app.post("/stats/reset")
+async def reset_stats():
+    calls.clear()
+    return {"ok": True}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    for name in latency:
+        parser.add_argument(f"--{name}-latency", type=float, default=latency[name] * 1000, help=f"{name} latency in ms")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of chat/embed/rerank calls that return 429")
+    args = parser.parse_args()
+    settings["error_rate"] = args.error_rate
+    for name in latency:
+        latency[name] = getattr(args, f"{name}_latency") / 1000
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
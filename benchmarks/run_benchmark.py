@@ -0,0 +1,217 @@
+"""Offline benchmark for /nlp/unified against local mock upstreams and in-memory Qdrant.
+
+Starts benchmarks/mock_upstreams.py and the API (uvicorn app.main:app) as subprocesses,
+drives each scenario at a fixed concurrency, and writes throughput, latency percentiles
+and upstream call counts as JSON so runs can be compared across commits:
+
+    python benchmarks/run_benchmark.py --requests 200 --concurrency 20 --output bench_results.json
+
+The API's result cache and single-flight use Redis, so a reachable ``--redis-url`` is
+required (``docker compose up -d redis``); ``--allow-no-redis`` runs without it and
+records that in the report.
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional
+
+import httpx
+import numpy as np
+import redis.asyncio as redis
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCENARIOS: Dict[str, tuple] = {
+    # name: (path, payload factory taking the request number and the run settings).
+    # Texts carry the run's tag so results cached in Redis by earlier runs never make a "cold" scenario warm.
+    "classify_cold": ("/nlp/unified", lambda i, run: {"text": f"Patient {i} ({run['tag']}) has fever and cough", "task": "classify", "categories": ["infectious", "chronic"]}),
+    "extract_entities_cold": ("/nlp/unified", lambda i, run: {"text": f"Patient {i} ({run['tag']}) diagnosed with acute bronchitis and asthma", "task": "extract_entities"}),
+    "summarize_cold": ("/nlp/unified", lambda i, run: {"text": f"Case {i} ({run['tag']}): cough is the most common illness-related reason for ambulatory care visits. Acute bronchitis is characterized by cough due to acute inflammation of the trachea.", "task": "summarize"}),
+    "sentiment_cold": ("/nlp/unified", lambda i, run: {"text": f"Trial {i} ({run['tag']}): new treatment for chronic kidney disease shows promising results", "task": "sentiment"}),
+    "cache_hot": ("/nlp/unified", lambda i, run: {"text": f"Patient ({run['tag']}) has fever and cough", "task": "classify", "categories": ["infectious", "chronic"]}),
+    "batch": ("/nlp/unified", lambda i, run: {"text": "", "task": "classify", "batch": [f"Patient {i}-{j} ({run['tag']}) has fever" for j in range(10)], "categories": ["infectious", "chronic"]}),
+    "multi_task": ("/nlp/unified", lambda i, run: {"text": f"Patient {i} ({run['tag']}) has fever and cough", "tasks": ["classify", "extract_entities", "sentiment"]}),
+    "stream_summarize": ("/nlp/stream", lambda i, run: {"text": f"Note {i} ({run['tag']}): patient reports persistent cough for two weeks.", "task": "summarize"}),
+    "webhook": ("/nlp/unified", lambda i, run: {"text": f"Patient {i} ({run['tag']}) has a rash", "task": "classify", "categories": ["infectious", "chronic"], "webhook_url": run["webhook_url"]}),
+}
+# Scenarios whose requests each end in one webhook result, delivered after the response
+WEBHOOK_SCENARIOS = {"webhook"}
+
+def start_process(args: List[str], env: Dict[str, str], log_path: str) -> subprocess.Popen:
+    # Log to a file: an unread pipe fills up and blocks the server
+    with open(log_path, "wb") as log:
+        process = subprocess.Popen(args, cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+    process.log_path = log_path
+    return process
+
+async def wait_ready(url: str, process: subprocess.Popen, timeout: float = 120.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                with open(process.log_path, encoding="utf-8", errors="replace") as log:
+                    raise RuntimeError(f"{url} exited early:\n{log.read()[-4000:]}")
+            try:
+                if (await client.get(url)).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.5)
+    raise TimeoutError(f"{url} not ready after {timeout}s")
+
+async def check_redis(url: str) -> Optional[str]:
+    """Return None if Redis answers at ``url``, else the error."""
+    client = redis.from_url(url, socket_connect_timeout=2, socket_timeout=2)
+    try:
+        await client.ping()
+        return None
+    except Exception as e:
+        return repr(e)
+    finally:
+        await client.aclose()
+
+async def wait_for_webhooks(client: httpx.AsyncClient, mock_url: str, expected: int, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if (await client.get(f"{mock_url}/stats")).json().get("webhook_items", 0) >= expected:
+            return
+        await asyncio.sleep(0.2)
+    print(f"Only some of {expected} webhooks arrived within {timeout}s")
+
+async def run_scenario(client: httpx.AsyncClient, mock_url: str, path: str, payload: Callable[[int], Dict], requests: int, concurrency: int,
+                       webhooks: bool = False) -> Dict:
+    await client.post(f"{mock_url}/stats/reset")
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], 0
+
+    async def one(i: int):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                response = await client.post(path, json=payload(i))
+                await response.aread()
+                if response.status_code >= 400:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    elapsed = time.perf_counter() - start
+    if webhooks:
+        # Not part of the measured latency: delivery happens after the response
+        await wait_for_webhooks(client, mock_url, requests - errors)
+    upstream = (await client.get(f"{mock_url}/stats")).json()
+    p50, p95, p99 = np.percentile(np.array(latencies) * 1000, [50, 95, 99])
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "errors": errors,
+        "throughput_rps": round(requests / elapsed, 2),
+        "latency_ms": {"p50": round(float(p50), 2), "p95": round(float(p95), 2), "p99": round(float(p99), 2), "max": round(max(latencies) * 1000, 2)},
+        "upstream_calls": upstream,
+    }
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except Exception:
+        return "unknown"
+
+async def main_async(args):
+    mock_url = f"http://127.0.0.1:{args.mock_port}"
+    api_url = f"http://127.0.0.1:{args.api_port}"
+    workdir = tempfile.mkdtemp(prefix="nlp-bench-")
+    redis_error = await check_redis(args.redis_url)
+    if redis_error is not None:
+        if not args.allow_no_redis:
+            raise SystemExit(f"Redis at {args.redis_url} is not reachable ({redis_error}). Start it (docker compose up -d redis) "
+                             "or pass --allow-no-redis to benchmark without it.")
+        print(f"Redis at {args.redis_url} is not reachable ({redis_error}); results will include failed Redis calls "
+              "and cache_hot only measures the in-process cache")
+    run = {"tag": uuid.uuid4().hex[:8], "webhook_url": f"{mock_url}/webhook"}
+    env = {
+        **os.environ,
+        "API_KEY": "bench",
+        "BASE_URL_CHAT": mock_url,
+        "BASE_URL_EMBED": mock_url,
+        "BASE_URL_RERANK": mock_url,
+        "QDRANT_URL": args.qdrant_url,
+        "REDIS_URL": args.redis_url,
+        "EMBEDDING_CACHE_PATH": os.path.join(workdir, "embeddings.sqlite3"),
+        "LOCAL_INDEX_DIR": os.path.join(workdir, "local_index"),
+        "CSV_LIMIT": str(args.csv_limit),
+        "HTTP2_ENABLED": "false",
+    }
+    mock = start_process([
+        sys.executable, "benchmarks/mock_upstreams.py", "--port", str(args.mock_port),
+        "--chat-latency", str(args.chat_latency), "--embed-latency", str(args.embed_latency),
+        "--rerank-latency", str(args.rerank_latency), "--webhook-latency", str(args.webhook_latency),
+        "--error-rate", str(args.error_rate),
+    ], env, os.path.join(workdir, "mock.log"))
+    api = start_process([sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(args.api_port), "--workers", str(args.workers), "--log-level", "warning"], env, os.path.join(workdir, "api.log"))
+    try:
+        await wait_ready(f"{mock_url}/stats", mock)
+        await wait_ready(f"{api_url}/cache/stats", api)
+        results = {}
+        async with httpx.AsyncClient(base_url=api_url, timeout=args.timeout, limits=httpx.Limits(max_connections=args.concurrency)) as client:
+            for name in args.scenarios:
+                path, factory = SCENARIOS[name]
+                payload = lambda i, factory=factory: factory(i, run)
+                if name == "cache_hot":
+                    await client.post(path, json=payload(0))
+                results[name] = await run_scenario(client, mock_url, path, payload, args.requests, args.concurrency, webhooks=name in WEBHOOK_SCENARIOS)
+                latency = results[name]["latency_ms"]
+                print(f"{name:24s} {results[name]['throughput_rps']:8.1f} rps  p50 {latency['p50']:8.1f}  p95 {latency['p95']:8.1f}  p99 {latency['p99']:8.1f} ms  errors {results[name]['errors']}  upstream {results[name]['upstream_calls']}")
+            cache_stats = (await client.get("/cache/stats")).json()
+    finally:
+        for process in (api, mock):
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "config": {**{k: v for k, v in vars(args).items() if k != "output"}, "redis_available": redis_error is None, "run_tag": run["tag"]},
+        "scenarios": results,
+        "cache_stats": cache_stats,
+    }
+    with open(args.output, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2)
+    print(f"Wrote {args.output} (server logs in {workdir})")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenarios", nargs="+", default=list(SCENARIOS), choices=list(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--csv-limit", type=int, default=200)
+    parser.add_argument("--chat-latency", type=float, default=300.0, help="ms")
+    parser.add_argument("--embed-latency", type=float, default=40.0, help="ms")
+    parser.add_argument("--rerank-latency", type=float, default=50.0, help="ms")
+    parser.add_argument("--webhook-latency", type=float, default=10.0, help="ms")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of upstream calls the mocks answer with 429")
+    parser.add_argument("--qdrant-url", default=":memory:", help="in-process Qdrant by default; its brute-force search is CPU-bound, so pass a real Qdrant URL for retrieval-heavy comparisons")
+    parser.add_argument("--redis-url", default=os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+    parser.add_argument("--allow-no-redis", action="store_true", help="run even if Redis is unreachable; the report's config says so")
+    parser.add_argument("--mock-port", type=int, default=9100)
+    parser.add_argument("--api-port", type=int, default=9000)
+    parser.add_argument("--output", default="bench_results.json")
+    asyncio.run(main_async(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,10 @@
+from app.cache import make_cache_key
+
+def test_cache_key_ignores_extra_whitespace():
+    assert make_cache_key("classify", "Malaria  is\ninfectious", None, "m") == make_cache_key("classify", " Malaria is infectious ", None, "m")
+
+def test_cache_key_keeps_category_order():
+    # The first category filters retrieval, so reordering can change related_docs
+    first = make_cache_key("classify", "text", ["infectious", "chronic"], "m")
+    second = make_cache_key("classify", "text", ["chronic", "infectious"], "m")
+    assert first != second
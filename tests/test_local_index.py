@@ -0,0 +1,21 @@
+from app.local_index import LocalVectorIndex
+
+def make_index():
+    texts = ["Malaria: an infectious disease", "Anemia in the mother and another child", "Other: not classified"]
+    return LocalVectorIndex.build(texts, [[1.0, 0.0], [0.9, 0.1], [0.0, 1.0]])
+
+def test_search_ranks_by_cosine_similarity():
+    hits = make_index().search([1.0, 0.0], limit=2)
+    assert [text for _, text in hits] == ["Malaria: an infectious disease", "Anemia in the mother and another child"]
+
+def test_category_filter_matches_whole_words():
+    hits = make_index().search([1.0, 0.0], limit=5, category="Other")
+    assert [text for _, text in hits] == ["Other: not classified"]
+
+def test_hot_set_uses_the_same_word_filter():
+    index = make_index()
+    index.add_hot('Mothers day -> {"category": "chronic"}', [1.0, 0.0])
+    index.add_hot('Flu -> {"category": "other"}', [1.0, 0.0])
+    texts = [text for _, text in index.search([1.0, 0.0], limit=5, category="other")]
+    assert 'Flu -> {"category": "other"}' in texts
+    assert 'Mothers day -> {"category": "chronic"}' not in texts
@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+
+from app.microbatch import MicroBatcher
+
+def run(make_awaitable):
+    async def scenario():
+        return await make_awaitable()
+    return asyncio.run(scenario())
+
+def recording_batcher(**kwargs):
+    calls = []
+
+    async def fn(items):
+        calls.append(list(items))
+        return [item * 2 for item in items]
+
+    return MicroBatcher(fn, **kwargs), calls
+
+def test_concurrent_items_share_one_call_after_max_wait():
+    batcher, calls = recording_batcher(max_batch=10, max_wait=0.01)
+    results = run(lambda: asyncio.gather(*(batcher.submit(i) for i in range(3))))
+    assert results == [0, 2, 4]
+    assert calls == [[0, 1, 2]]
+
+def test_full_batch_is_sent_without_waiting():
+    batcher, calls = recording_batcher(max_batch=2, max_wait=60.0)
+
+    assert run(lambda: asyncio.wait_for(asyncio.gather(*(batcher.submit(i) for i in range(4))), 1)) == [0, 2, 4, 6]
+    assert calls == [[0, 1], [2, 3]]
+
+def test_identical_items_are_sent_once():
+    batcher, calls = recording_batcher(max_batch=10, max_wait=0.01)
+    results = run(lambda: asyncio.gather(batcher.submit(5), batcher.submit(5), batcher.submit(1)))
+    assert results == [10, 10, 2]
+    assert calls == [[5, 1]]
+
+def test_failure_is_raised_to_every_caller():
+    async def fn(items):
+        raise RuntimeError("upstream down")
+
+    batcher = MicroBatcher(fn, max_batch=10, max_wait=0.01)
+    results = run(lambda: asyncio.gather(batcher.submit(1), batcher.submit(2), return_exceptions=True))
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+def test_wrong_result_count_is_an_error():
+    async def fn(items):
+        return items[:1]
+
+    batcher = MicroBatcher(fn, max_batch=10, max_wait=0.01)
+    with pytest.raises(ValueError):
+        run(lambda: asyncio.gather(batcher.submit(1), batcher.submit(2)))
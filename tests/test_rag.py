@@ -0,0 +1,25 @@
+import asyncio
+import os
+
+os.environ.setdefault("QDRANT_URL", ":memory:")  # no Qdrant server needed
+
+from app import rag  # noqa: E402
+
+def test_embed_text_and_get_embeddings_do_not_share_flights(monkeypatch):
+    calls = []
+
+    async def fake_get_embeddings(texts):
+        calls.append(list(texts))
+        await asyncio.sleep(0.05)
+        return [[float(len(text)), 0.0] for text in texts]
+
+    monkeypatch.setattr(rag, "_get_embeddings", fake_get_embeddings)
+    monkeypatch.setattr(rag.embedding_batcher, "fn", fake_get_embeddings)
+
+    async def scenario():
+        return await asyncio.gather(rag.get_embeddings(["same text"]), rag.embed_text("same text"))
+
+    batch, single = asyncio.run(scenario())
+    assert batch == [[9.0, 0.0]]
+    assert single == [9.0, 0.0]
+    assert len(calls) == 2
@@ -0,0 +1,185 @@
+import asyncio
+
+import httpx
+import pytest
+
+from app import upstream as upstream_module
+from app.upstream import AdaptiveLimiter, CircuitBreaker, CircuitOpenError, Upstream
+
+def run(coro):
+    return asyncio.run(coro)
+
+def make_upstream(monkeypatch, handler, name="embed", hedge=False, retries=0, threshold=5, cooldown=30.0):
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(upstream_module, "get_client", lambda _: client)
+    upstream = Upstream(name)
+    upstream.retries = retries
+    upstream.hedge = hedge
+    upstream.breaker = CircuitBreaker(name, threshold=threshold, cooldown=cooldown)
+    return upstream
+
+# Limiter
+
+def test_limiter_waits_for_a_free_slot_and_wakes_on_release():
+    async def scenario():
+        limiter = AdaptiveLimiter("test", initial=2, minimum=1, maximum=4, tolerance=2.0)
+        await limiter.acquire()
+        await limiter.acquire()
+        waiter = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        assert not waiter.done()
+        limiter.release()
+        await asyncio.wait_for(waiter, 1)
+        assert limiter.in_flight == 2
+
+    run(scenario())
+
+def test_limiter_cancelled_waiter_is_removed():
+    async def scenario():
+        limiter = AdaptiveLimiter("test", initial=1, minimum=1, maximum=4, tolerance=2.0)
+        await limiter.acquire()
+        waiter = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert not limiter._waiters
+        limiter.release()
+        assert limiter.in_flight == 0
+
+    run(scenario())
+
+def test_limiter_woken_then_cancelled_waiter_passes_the_slot_on():
+    async def scenario():
+        limiter = AdaptiveLimiter("test", initial=1, minimum=1, maximum=4, tolerance=2.0)
+        await limiter.acquire()
+        first = asyncio.ensure_future(limiter.acquire())
+        second = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        limiter.release()  # wakes first
+        first.cancel()  # ...which is cancelled before it takes the slot
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        await asyncio.wait_for(second, 1)
+        assert limiter.in_flight == 1
+
+    run(scenario())
+
+def test_limiter_halves_on_overload_and_grows_on_success():
+    limiter = AdaptiveLimiter("test", initial=8, minimum=1, maximum=16, tolerance=2.0)
+    limiter.on_sample(0.01, overloaded=True)
+    assert int(limiter.limit) == 4
+    for _ in range(20):
+        limiter.on_sample(0.01)
+    assert limiter.limit > 4
+
+# Breaker
+
+def test_breaker_opens_after_threshold_and_lets_one_probe_through(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(upstream_module.time, "monotonic", lambda: now[0])
+    breaker = CircuitBreaker("test", threshold=2, cooldown=10.0)
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    now[0] += 10.0
+    assert breaker.state == "half_open"
+    breaker.before_call()  # the probe
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()  # only one probe at a time
+    breaker.record_success()
+    assert breaker.state == "closed"
+    breaker.before_call()
+
+def test_breaker_failed_probe_reopens(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(upstream_module.time, "monotonic", lambda: now[0])
+    breaker = CircuitBreaker("test", threshold=1, cooldown=10.0)
+    breaker.record_failure()
+    now[0] += 10.0
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == "open"
+
+def test_breaker_cancelled_probe_allows_another(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(upstream_module.time, "monotonic", lambda: now[0])
+    breaker = CircuitBreaker("test", threshold=1, cooldown=10.0)
+    breaker.record_failure()
+    now[0] += 10.0
+    breaker.before_call()
+    breaker.cancel_probe()
+    breaker.before_call()
+
+def test_throttling_does_not_open_the_breaker(monkeypatch):
+    upstream = make_upstream(monkeypatch, lambda request: httpx.Response(429, headers={"Retry-After": "0"}), threshold=2)
+
+    async def scenario():
+        for _ in range(5):
+            response = await upstream.post("http://upstream/embeddings")
+            assert response.status_code == 429
+
+    run(scenario())
+    assert upstream.breaker.state == "closed"
+
+def test_server_errors_open_the_breaker(monkeypatch):
+    upstream = make_upstream(monkeypatch, lambda request: httpx.Response(500), threshold=2)
+
+    async def scenario():
+        await upstream.post("http://upstream/embeddings")
+        await upstream.post("http://upstream/embeddings")
+        with pytest.raises(CircuitOpenError):
+            await upstream.post("http://upstream/embeddings")
+
+    run(scenario())
+
+# Hedging
+
+def hedging_upstream(monkeypatch, delays, statuses=None):
+    """Upstream whose n-th call answers after delays[n] seconds with statuses[n]."""
+    calls = []
+
+    async def handler(request):
+        index = len(calls)
+        calls.append(index)
+        await asyncio.sleep(delays[index])
+        return httpx.Response((statuses or {}).get(index, 200), json={"call": index})
+
+    upstream = make_upstream(monkeypatch, handler, hedge=True)
+    upstream._latencies.extend([0.02] * 20)
+    return upstream, calls
+
+def test_hedge_returns_the_faster_second_request(monkeypatch):
+    upstream, calls = hedging_upstream(monkeypatch, [1.0, 0.0])
+    response = run(upstream.post("http://upstream/embeddings"))
+    assert response.json() == {"call": 1}
+    assert len(calls) == 2
+
+def test_no_hedge_when_the_first_request_is_fast(monkeypatch):
+    upstream, calls = hedging_upstream(monkeypatch, [0.0, 0.0])
+    response = run(upstream.post("http://upstream/embeddings"))
+    assert response.json() == {"call": 0}
+    assert len(calls) == 1
+
+def test_no_hedge_without_a_free_slot(monkeypatch):
+    upstream, calls = hedging_upstream(monkeypatch, [0.1, 0.0])
+    upstream.limiter.limit = 1.0
+    upstream.limiter.maximum = 1
+    response = run(upstream.post("http://upstream/embeddings"))
+    assert response.json() == {"call": 0}
+    assert len(calls) == 1
+
+def test_hedge_falls_back_to_the_first_response_when_both_are_retryable(monkeypatch):
+    upstream, calls = hedging_upstream(monkeypatch, [0.1, 0.0], statuses={0: 503, 1: 429})
+    response = run(upstream.post("http://upstream/embeddings"))
+    assert response.status_code == 503
+    assert len(calls) == 2
+
+def test_hedge_ignores_a_failed_copy_and_waits_for_the_other(monkeypatch):
+    upstream, calls = hedging_upstream(monkeypatch, [0.1, 0.0], statuses={1: 503})
+    response = run(upstream.post("http://upstream/embeddings"))
+    assert response.json() == {"call": 0}
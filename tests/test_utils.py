@@ -0,0 +1,18 @@
+import pytest
+
+from app.utils import split_text
+
+def test_split_text_respects_max_chars_and_overlap():
+    text = "One sentence here. Another sentence there. A third one follows. And a fourth."
+    chunks = split_text(text, 40, overlap=20)
+    assert len(chunks) > 1
+    assert all(len(chunk) <= 40 for chunk in chunks)
+    assert chunks[1].startswith("Another sentence there.")
+
+def test_split_text_hard_splits_long_sentences():
+    assert split_text("x" * 10, 4) == ["xxxx", "xxxx", "xx"]
+
+@pytest.mark.parametrize("max_chars", [0, -5])
+def test_split_text_rejects_non_positive_max_chars(max_chars):
+    with pytest.raises(ValueError):
+        split_text("Some text.", max_chars)
@@ -0,0 +1,70 @@
+import asyncio
+
+import pytest
+
+from app import webhooks
+from app.webhooks import WEBHOOK_QUEUE_KEY, WebhookDispatcher
+
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")  # fakeredis needs it to run the Lua scripts
+
+def run(coro):
+    return asyncio.run(coro)
+
+def test_startup_recovery_requeues_own_leftover_jobs():
+    async def scenario():
+        redis_client = fakeredis.aioredis.FakeRedis()
+        dispatcher = WebhookDispatcher(redis_client, "a")
+        await redis_client.rpush(dispatcher.processing_key, b"job")
+        await dispatcher.recover()
+        assert await redis_client.lrange(WEBHOOK_QUEUE_KEY, 0, -1) == [b"job"]
+        assert await redis_client.llen(dispatcher.processing_key) == 0
+
+    run(scenario())
+
+def test_sweep_leaves_live_dispatchers_alone_and_takes_expired_ones():
+    async def scenario():
+        redis_client = fakeredis.aioredis.FakeRedis()
+        first, second = WebhookDispatcher(redis_client, "a"), WebhookDispatcher(redis_client, "b")
+        await first.renew_lease()
+        await second.renew_lease()
+        await redis_client.rpush(first.processing_key, b"a-job")
+        await redis_client.rpush(second.processing_key, b"b-job")
+
+        await first.sweep_stale()
+        await second.sweep_stale()
+        assert await redis_client.llen(WEBHOOK_QUEUE_KEY) == 0
+
+        await redis_client.delete(second.lease_key)  # b stops renewing
+        await first.sweep_stale()
+        assert await redis_client.lrange(WEBHOOK_QUEUE_KEY, 0, -1) == [b"b-job"]
+        assert await redis_client.lrange(first.processing_key, 0, -1) == [b"a-job"]
+
+    run(scenario())
+
+def test_periodic_sweep_never_requeues_own_in_flight_jobs(monkeypatch):
+    monkeypatch.setattr(webhooks, "WEBHOOK_LEASE_TTL", 1)
+    monkeypatch.setattr(webhooks, "WEBHOOK_RETRY_POLL", 0.01)
+
+    async def scenario():
+        redis_client = fakeredis.aioredis.FakeRedis()
+        dispatcher = WebhookDispatcher(redis_client, "a")
+        await redis_client.rpush(dispatcher.processing_key, b"in-flight")
+        stop = asyncio.Event()
+        sweeps = []
+        original = dispatcher.sweep_stale
+
+        async def sweep_stale():
+            sweeps.append(1)
+            await original()
+
+        dispatcher.sweep_stale = sweep_stale
+        promoter = asyncio.create_task(dispatcher._promote_loop(stop))
+        await asyncio.sleep(1.2)
+        stop.set()
+        await promoter
+        assert sweeps
+        assert await redis_client.llen(WEBHOOK_QUEUE_KEY) == 0
+        assert await redis_client.lrange(dispatcher.processing_key, 0, -1) == [b"in-flight"]
+
+    run(scenario())